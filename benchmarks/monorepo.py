@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+"""Measures how releash scales with the size of a monorepo.
+
+Generates throwaway git repos with N packages, M tags and K commits, and times the
+releash commands in them, each in a fresh interpreter:
+
+    $ python benchmarks/monorepo.py --packages 10 100 1000 --tags 2000 --commits 500
+
+For each command the wall time, the number of subprocesses releash started (from the
+--profile-trace events) and the peak memory (max rss from os.wait4) are reported. Results are
+stored per commit of releash in .benchmarks/monorepo/<commit>.json, so that
+
+    $ python benchmarks/monorepo.py --compare <other commit>
+
+shows the difference with an earlier run.
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+commands = [
+    ('list', ['list']),
+    ('status', ['status']),
+    ('diff', ['diff']),
+    ('bump -n', ['bump', '--dry-run']),
+    ('set -n', ['set', '--dry-run']),
+]
+
+config_template = '''from releash import *
+for i in range({packages}):
+    name = 'pkg%d' % i
+    package = add_package(name)
+    package.version_source = VersionSource(package)
+    package.version_targets.append(VersionTarget(package))
+    package.tag_targets.append(ReleaseTargetGitTagVersion(package.version_source, prefix=name + '-v'))
+'''
+
+
+def _data(text):
+    data = text.encode('utf-8')
+    return b'data ' + str(len(data)).encode('ascii') + b'\n' + data + b'\n'
+
+
+def generate(directory, packages, tags, commits):
+    """Creates a git repo in directory, using a single git fast-import so that large repos are quick to make
+
+    Every package gets max(1, tags // packages) tags, with the last one matching the current version.
+    The commits after the first each change a file of one of the packages, so some packages have
+    changes since their last tag.
+    """
+    tags_per_package = max(1, tags // packages)
+    subprocess.check_call(['git', 'init', '-q', directory])
+    git = ['git', '-C', directory]
+    subprocess.check_call(git + ['symbolic-ref', 'HEAD', 'refs/heads/master'])
+    subprocess.check_call(git + ['config', 'user.name', 'releash benchmark'])
+    subprocess.check_call(git + ['config', 'user.email', 'benchmark@example.com'])
+    stream = []
+    committer = b'committer releash benchmark <benchmark@example.com> 1500000000 +0000\n'
+    stream.append(b'commit refs/heads/master\nmark :1\n' + committer + _data('initial packages'))
+    stream.append(b'M 644 inline .releash.py\n' + _data(config_template.format(packages=packages)))
+    version = '0.1.{}'.format(tags_per_package - 1)
+    for i in range(packages):
+        name = 'pkg{}'.format(i)
+        stream.append('M 644 inline {0}/{0}/_version.py\n'.format(name).encode('utf-8') +
+                      _data("__version_tuple__ = (0, 1, {})\n__version__ = '{}'\n".format(tags_per_package - 1, version)))
+        stream.append('M 644 inline {0}/setup.py\n'.format(name).encode('utf-8') +
+                      _data("from setuptools import setup\nsetup(name='{}', version='{}')\n".format(name, version)))
+    for commit in range(2, commits + 1):
+        name = 'pkg{}'.format((commit * 7919) % packages)  # spread the changes over the packages
+        stream.append('commit refs/heads/master\nmark :{}\n'.format(commit).encode('utf-8') + committer +
+                      _data('change {} of {}'.format(commit, name)))
+        stream.append('M 644 inline {0}/{0}/data.txt\n'.format(name).encode('utf-8') + _data(str(commit)))
+    for i in range(packages):
+        for j in range(tags_per_package):
+            # older tags at earlier commits, the last tag of a package somewhere in the history
+            mark = 1 + (i + j * packages) * (commits - 1) // max(1, packages * tags_per_package)
+            stream.append('reset refs/tags/pkg{}-v0.1.{}\nfrom :{}\n\n'.format(i, j, mark).encode('utf-8'))
+    process = subprocess.Popen(git + ['fast-import', '--quiet'], stdin=subprocess.PIPE)
+    process.communicate(b''.join(stream))
+    if process.returncode != 0:
+        raise RuntimeError('git fast-import failed')
+    subprocess.check_call(git + ['reset', '-q', '--hard'])
+
+
+def measure(directory, args, runs):
+    """Returns the median (seconds, subprocesses, max rss in KB) of running releash with args in directory"""
+    env = dict(os.environ, PYTHONPATH=root + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    trace = os.path.join(directory, '.git', 'benchmark-trace.json')
+    code = 'import sys, releash; releash.main(["releash"] + sys.argv[1:])'
+    results = []
+    for i in range(runs):
+        start = time.time()
+        with open(os.devnull, 'w') as devnull:
+            process = subprocess.Popen([sys.executable, '-c', code] + args + ['--profile-trace', trace],
+                                       cwd=directory, env=env, stdout=devnull)
+            pid, status, rusage = os.wait4(process.pid, 0)
+        duration = time.time() - start
+        if status != 0:
+            raise RuntimeError('releash {} failed in {}'.format(' '.join(args), directory))
+        with open(trace) as f:
+            subprocesses = len(json.load(f)['traceEvents'])
+        max_rss = rusage.ru_maxrss // 1024 if sys.platform == 'darwin' else rusage.ru_maxrss  # bytes on macOS
+        results.append((duration, subprocesses, max_rss))
+    return sorted(results)[len(results) // 2]
+
+
+def releash_commit():
+    try:
+        output = subprocess.check_output(['git', '-C', root, 'rev-parse', '--short', 'HEAD'])
+        commit = output.decode('ascii').strip()
+    except (subprocess.CalledProcessError, OSError):
+        return 'unknown'
+    dirty = subprocess.call(['git', '-C', root, 'diff', '--quiet', 'HEAD', '--', 'releash.py'])
+    return commit + ('-dirty' if dirty else '')
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(argv[0])
+    parser.add_argument('--packages', '-N', type=int, nargs='+', default=[10, 100, 1000],
+                        help="number of packages, one repo per value")
+    parser.add_argument('--tags', '-M', type=int, default=None, help="number of tags (default: 2 per package)")
+    parser.add_argument('--commits', '-K', type=int, default=100, help="number of commits")
+    parser.add_argument('--runs', '-r', type=int, default=3, help="number of runs per command (the median is used)")
+    parser.add_argument('--output', default=os.path.join(root, '.benchmarks', 'monorepo'),
+                        help="directory to store the results in")
+    parser.add_argument('--compare', default=None, metavar='COMMIT',
+                        help="compare with the stored results of this commit")
+    parser.add_argument('--keep', action='store_true', default=False, help="do not remove the generated repos")
+    args = parser.parse_args(argv[1:])
+
+    baseline = None
+    if args.compare:
+        with open(os.path.join(args.output, args.compare + '.json')) as f:
+            baseline = {(k['packages'], k['command']): k for k in json.load(f)['results']}
+
+    results = []
+    print('{:>8} {:10} {:>10} {:>10} {:>10} {:>10}'.format('packages', 'command', 'time (ms)', 'processes',
+                                                          'rss (MB)', 'vs ' + args.compare if args.compare else ''))
+    for packages in args.packages:
+        tags = args.tags if args.tags is not None else 2 * packages
+        directory = tempfile.mkdtemp(prefix='releash-benchmark-{}-'.format(packages))
+        try:
+            generate(directory, packages, tags, args.commits)
+            for name, command in commands:
+                duration, subprocesses, max_rss = measure(directory, command, args.runs)
+                result = dict(packages=packages, tags=tags, commits=args.commits, command=name,
+                              seconds=duration, subprocesses=subprocesses, max_rss_kb=max_rss)
+                results.append(result)
+                comparison = ''
+                previous = baseline.get((packages, name)) if baseline else None
+                if previous:
+                    comparison = '{:+.0f}%'.format((duration / previous['seconds'] - 1) * 100)
+                print('{:>8} {:10} {:>10.1f} {:>10} {:>10.1f} {:>10}'.format(
+                      packages, name, duration * 1000, subprocesses, max_rss / 1024., comparison))
+        finally:
+            if args.keep:
+                print('kept {}'.format(directory))
+            else:
+                shutil.rmtree(directory)
+
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    filename = os.path.join(args.output, releash_commit() + '.json')
+    with open(filename, 'w') as f:
+        json.dump(dict(commit=releash_commit(), python=sys.version.split()[0], results=results), f, indent=2)
+    print('results written to {}'.format(filename))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""Measures the cold start time of releash, to catch startup regressions.
+
+Every run starts a fresh interpreter, like running releash from the command line does.
+
+    $ python benchmarks/startup.py --runs 10 --max-ms 500 path/to/repo
+
+The directory (default: the current one) should contain a .releash.py file. With --max-ms
+the exit code is 1 when the median time of a command is above that limit.
+"""
+from __future__ import print_function
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+commands = [
+    ('import', 'import releash'),
+    ('list', 'import releash; releash.main(["releash", "list"])'),
+    ('status', 'import releash; releash.main(["releash", "status"])'),
+]
+
+
+def measure(code, directory, runs):
+    env = dict(os.environ, PYTHONPATH=root + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    times = []
+    for i in range(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', code], cwd=directory, env=env,
+                              stdout=subprocess.DEVNULL)
+        times.append(time.time() - start)
+    return sorted(times)
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(argv[0])
+    parser.add_argument('directory', nargs='?', default='.', help="directory with a .releash.py file")
+    parser.add_argument('--runs', '-r', type=int, default=10, help="number of runs per command")
+    parser.add_argument('--max-ms', type=float, default=None, help="fail when a median is above this")
+    args = parser.parse_args(argv[1:])
+
+    too_slow = []
+    print('{:10} {:>10} {:>10}'.format('command', 'min (ms)', 'median (ms)'))
+    for name, code in commands:
+        times = measure(code, args.directory, args.runs)
+        median = times[len(times) // 2] * 1000
+        print('{:10} {:10.1f} {:10.1f}'.format(name, times[0] * 1000, median))
+        if args.max_ms is not None and median > args.max_ms:
+            too_slow.append(name)
+    if too_slow:
+        print('too slow (more than {} ms): {}'.format(args.max_ms, ', '.join(too_slow)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
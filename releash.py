@@ -1,25 +1,17 @@
 #!/usr/bin/env python
 from __future__ import print_function
 from contextlib import contextmanager
-import hashlib
-import imp
+import collections
+import io
+import json
 import os
-import pkg_resources
 import re
 import shutil
+import subprocess
 import sys
-import tempfile
+import threading
 import time
 
-import semver
-
-try:
-    from urllib import urlretrieve  # py2
-    HTTPError = Exception
-except ImportError:
-    from urllib.request import urlretrieve  # py3
-    from urllib.error import HTTPError
-
 __version_tuple__ = (0, 5, 1)
 __version__ = '0.5.1'
 
@@ -33,8 +25,41 @@ force = False  # force commands, such as tagging
 verbose = False
 quiet = False
 interactive = False
-semver_bump = [semver.bump_major, semver.bump_minor,
-               semver.bump_patch, semver.bump_prerelease, semver.bump_build]
+jobs = 1  # number of packages to process in parallel
+
+# heavy modules (semver, hashlib, packaging, ...) are imported where they are used, to keep
+# the startup time of e.g. releash status low, see benchmarks/startup.py
+
+
+def _semver_bump():
+    import semver
+    return [semver.bump_major, semver.bump_minor,
+            semver.bump_patch, semver.bump_prerelease, semver.bump_build]
+
+
+def format_version(major, minor, patch, prerelease=None, build=None):
+    """Same as semver.format_version"""
+    version = "%d.%d.%d" % (major, minor, patch)
+    if prerelease is not None:
+        version += "-%s" % prerelease
+    if build is not None:
+        version += "+%s" % build
+    return version
+
+
+def safe_version(version):
+    """Normalizes a version like setuptools does (pkg_resources.safe_version), e.g. 1.0.0-beta.1 -> 1.0.0b1"""
+    try:
+        from packaging.version import Version, InvalidVersion
+    except ImportError:
+        pass
+    else:
+        try:
+            return str(Version(version))
+        except InvalidVersion:
+            pass
+    version = version.replace(' ', '.')
+    return re.sub('[^A-Za-z0-9.]+', '-', version)
 
 
 _to_null = ' > nul 2>&1' if os.name == 'nt' else ' 2> /dev/null 1> /dev/null'
@@ -64,17 +89,640 @@ def print_file(f, value, **kwargs):
     print(value, file=f, **kwargs)
 
 
-def download(url, filename, retries=10, sleep=6):
-    i = 0
-    while i < retries:
+def cache_dir(*names):
+    """Directory in releash's cache ($RELEASH_CACHE_DIR, or ~/.cache/releash), created on demand"""
+    root = os.environ.get('RELEASH_CACHE_DIR') or \
+        os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(os.path.join('~', '.cache')), 'releash')
+    path = os.path.join(root, *names)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    return path
+
+
+_cache_in_use = set()  # files in caches that were handed out in this run, see evict_lru
+
+
+def evict_lru(path, max_bytes, keep=()):
+    """Removes the least recently used files (by mtime) in path until the total size is below max_bytes
+
+    Files in keep, and files handed out by the caches in this run, are never removed, even when
+    that leaves the total above max_bytes.
+    """
+    keep = set(os.path.abspath(k) for k in keep) | _cache_in_use
+    entries = []
+    total = 0
+    for name in os.listdir(path):
+        filename = os.path.join(path, name)
+        if os.path.isfile(filename):
+            stat = os.stat(filename)
+            total += stat.st_size
+            if os.path.abspath(filename) not in keep:
+                entries.append((stat.st_mtime, stat.st_size, filename))
+    for mtime, size, filename in sorted(entries):
+        if total <= max_bytes:
+            break
+        debug('evicting {} from cache', filename)
+        os.remove(filename)
+        total -= size
+
+
+def _write_json(filename, value):
+    # write to a temporary file first, so a crash can not leave a half written file
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(value, f, indent=2)
+    os.replace(filename + '.tmp', filename)
+
+
+def _read_json(filename, default):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return default
+
+
+class Downloader(object):
+    """Downloads files into a content addressed cache.
+
+    Files are stored under their sha256 (objects/<sha256>), and urls.json maps urls to those, so
+    a url is only downloaded once. Interrupted transfers are resumed with HTTP Range requests,
+    failures are retried with exponential backoff (with jitter), and the least recently used
+    objects are evicted when the cache grows beyond max_bytes.
+    """
+    chunk_size = 1024 * 1024
+    lock = threading.Lock()
+
+    def __init__(self, path=None, max_bytes=2 * 1024**3, retries=10, sleep=1, max_sleep=60):
+        self.path = path or cache_dir('downloads')
+        self.objects_path = os.path.join(self.path, 'objects')
+        self.partial_path = os.path.join(self.path, 'partial')
+        for path in [self.objects_path, self.partial_path]:
+            if not os.path.exists(path):
+                os.makedirs(path)
+        self.index_filename = os.path.join(self.path, 'urls.json')
+        self.max_bytes = max_bytes
+        self.retries = retries
+        self.sleep = sleep
+        self.max_sleep = max_sleep
+
+    def cached(self, url):
+        """Returns the filename of the cached download of url, or None"""
+        with self.lock:
+            sha256 = _read_json(self.index_filename, {}).get(url)
+        filename = os.path.join(self.objects_path, sha256) if sha256 else None
+        if filename and os.path.exists(filename):
+            os.utime(filename, None)  # mark as recently used
+            _cache_in_use.add(os.path.abspath(filename))
+            return filename
+
+    def get(self, url):
+        """Returns the filename of url in the cache, downloading it when needed"""
+        filename = self.cached(url)
+        if filename:
+            debug('using cached download of {}: {}', url, filename)
+            return filename
+        import hashlib
+        partial = os.path.join(self.partial_path, hashlib.sha256(url.encode('utf8')).hexdigest())
+        self._download(url, partial)
+        sha256 = hash_file(partial, ('sha256',))['sha256']
+        filename = os.path.join(self.objects_path, sha256)
+        os.replace(partial, filename)
+        with self.lock:
+            index = _read_json(self.index_filename, {})
+            index[url] = sha256
+            _write_json(self.index_filename, index)
+        _cache_in_use.add(os.path.abspath(filename))
+        evict_lru(self.objects_path, self.max_bytes)
+        return filename
+
+    def _download(self, url, filename):
+        import random
         try:
-            urlretrieve(url, filename)
-            return
-        except HTTPError:
-            info('failed to download {}, will try again in {} seconds', url, sleep)
-            i += 1
-            time.sleep(sleep)
-    error('could now download {}', url)
+            from urllib.request import urlopen, Request
+            from urllib.error import HTTPError, URLError
+        except ImportError:  # py2
+            from urllib2 import urlopen, Request, HTTPError, URLError
+        for attempt in range(self.retries):
+            offset = os.path.getsize(filename) if os.path.exists(filename) else 0
+            request = Request(url, headers={'Range': 'bytes=%d-' % offset} if offset else {})
+            try:
+                response = urlopen(request, timeout=60)
+                # a server that does not support ranges sends the whole file
+                mode = 'ab' if offset and response.getcode() == 206 else 'wb'
+                if mode == 'ab':
+                    debug('resuming download of {} at byte {}', url, offset)
+                with open(filename, mode) as f:
+                    for chunk in iter(lambda: response.read(self.chunk_size), b''):
+                        f.write(chunk)
+                length = response.headers.get('Content-Length')
+                expected = int(length) + (offset if mode == 'ab' else 0) if length else None
+                response.close()
+                if expected is None or os.path.getsize(filename) == expected:
+                    return
+                info('download of {} incomplete', url)
+            except HTTPError as e:
+                if e.code == 416:  # our partial file is not a prefix of what the server has
+                    os.remove(filename)
+                elif 400 <= e.code < 500 and e.code not in (408, 429):
+                    error('could not download {}: {}', url, e)
+                else:
+                    info('failed to download {}: {}', url, e)
+            except (URLError, IOError, OSError) as e:
+                info('failed to download {}: {}', url, e)
+            if attempt < self.retries - 1:
+                delay = min(self.max_sleep, self.sleep * 2 ** attempt) * random.uniform(0.5, 1)
+                info('will try again in {:.1f} seconds', delay)
+                time.sleep(delay)
+        error('could not download {}', url)
+
+
+def download(url, filename=None, **kwargs):
+    """Downloads url (via the cache), copies it to filename if given, and returns the path of the file"""
+    cached = Downloader(**kwargs).get(url)
+    if filename is None:
+        return cached
+    shutil.copy(cached, filename)
+    return filename
+
+
+class BuildCache(object):
+    """Stores built distributions (sdist, wheel), keyed by the git tree of the package and the build commands.
+
+    The artifacts are stored under their sha256 (objects/<sha256>), builds/<key>.json lists the
+    artifacts of a build. Packages with uncommitted changes or untracked files are not cached,
+    since the tree hash would not describe what is built. The least recently used objects are evicted when the
+    cache grows beyond max_bytes.
+    """
+
+    def __init__(self, path=None, max_bytes=5 * 1024**3):
+        self.path = path or cache_dir('builds')
+        self.objects_path = os.path.join(self.path, 'objects')
+        self.builds_path = os.path.join(self.path, 'builds')
+        for path in [self.objects_path, self.builds_path]:
+            if not os.path.exists(path):
+                os.makedirs(path)
+        self.max_bytes = max_bytes
+
+    def key(self, path, commands):
+        """Returns the cache key for building path with commands, or None when it cannot be cached"""
+        import hashlib
+        exit_code, tree = capture('git rev-parse HEAD:./{}'.format(path))
+        if exit_code != 0:
+            return None
+        exit_code, changes = capture('git status --porcelain --untracked-files=no -- {}'.format(path))
+        if exit_code != 0 or changes.strip():
+            debug('not using the build cache for {}, it has uncommitted changes', path)
+            return None
+        # setuptools also puts untracked (but not ignored) files in the sdist
+        exit_code, untracked = capture('git ls-files --others --exclude-standard -- {}'.format(path))
+        if exit_code != 0 or untracked.strip():
+            debug('not using the build cache for {}, it has untracked files', path)
+            return None
+        key = json.dumps([tree.strip(), commands])
+        return hashlib.sha256(key.encode('utf8')).hexdigest()
+
+    def get(self, key):
+        """Returns [(filename, object filename)] of the cached build, or None"""
+        build = _read_json(os.path.join(self.builds_path, key + '.json'), None)
+        if build is None:
+            return None
+        artifacts = [(name, os.path.join(self.objects_path, sha256)) for name, sha256 in build]
+        if not all(os.path.exists(filename) for name, filename in artifacts):
+            return None  # (partly) evicted
+        for name, filename in artifacts:
+            os.utime(filename, None)  # mark as recently used
+            _cache_in_use.add(os.path.abspath(filename))
+        return artifacts
+
+    def restore(self, key, dist_path):
+        artifacts = self.get(key)
+        if artifacts is None:
+            error('build {} is no longer in the cache', key)
+        if not os.path.exists(dist_path):
+            os.makedirs(dist_path)
+        for name, filename in artifacts:
+            info('using cached {}', name)
+            shutil.copy(filename, os.path.join(dist_path, name))
+
+    def store(self, key, filenames):
+        build = []
+        for filename in filenames:
+            sha256 = hash_file(filename, ('sha256',))['sha256']
+            target = os.path.join(self.objects_path, sha256)
+            if not os.path.exists(target):
+                shutil.copy(filename, target + '.tmp')
+                os.replace(target + '.tmp', target)
+            build.append((os.path.basename(filename), sha256))
+        _write_json(os.path.join(self.builds_path, key + '.json'), build)
+        evict_lru(self.objects_path, self.max_bytes,
+                  keep=[os.path.join(self.objects_path, sha256) for name, sha256 in build])
+
+
+_hash_cache = {}
+
+
+def hash_file(filename, algorithms=('sha256', 'md5'), chunk_size=1024 * 1024):
+    """Returns {algorithm: hex digest} for filename, computing all digests in one pass.
+
+    The file is read in chunks, so memory use does not depend on the file size, and results are
+    cached by path, size and modification time, so a file is hashed at most once per run.
+    """
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+    digests = _hash_cache.setdefault(key, {})
+    missing = [k for k in algorithms if k not in digests]
+    if missing:
+        import hashlib
+        hashes = [hashlib.new(k) for k in missing]
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                for hash in hashes:
+                    hash.update(chunk)
+        for name, hash in zip(missing, hashes):
+            digests[name] = hash.hexdigest()
+    return {k: digests[k] for k in algorithms}
+
+
+def read_sdist_files(filename, names):
+    """Returns {name: text} for the files in names found in the sdist at filename
+
+    PKG-INFO is looked up in the top directory, other names (like requires.txt) in the .egg-info
+    directory. The tarball is streamed, and only read until all names are found.
+    """
+    import tarfile
+    found = {}
+    with tarfile.open(filename, 'r|*') as archive:
+        for member in archive:
+            parts = member.name.split('/')
+            name = parts[-1]
+            if name not in names or name in found or not member.isfile():
+                continue
+            if (name == 'PKG-INFO' and len(parts) == 2) or \
+               (name != 'PKG-INFO' and len(parts) >= 3 and parts[-2].endswith('.egg-info')):
+                found[name] = archive.extractfile(member).read().decode('utf-8')
+                if len(found) == len(names):
+                    break
+    return found
+
+
+def read_dist_metadata(filename):
+    """Returns the metadata (PKG-INFO or METADATA) of an sdist or wheel as an email.message.Message
+
+    The archive is streamed, an sdist is only read until its PKG-INFO is found.
+    """
+    import email.parser
+    text = None
+    if filename.endswith('.whl'):
+        import zipfile
+        with zipfile.ZipFile(filename) as archive:
+            for name in archive.namelist():
+                parts = name.split('/')
+                if len(parts) == 2 and parts[0].endswith('.dist-info') and parts[1] == 'METADATA':
+                    text = archive.read(name).decode('utf-8')
+                    break
+    else:
+        text = read_sdist_files(filename, ['PKG-INFO']).get('PKG-INFO')
+    if text is None:
+        error('no metadata found in {}', filename)
+    return email.parser.Parser().parsestr(text)
+
+
+def read_pyproject(path):
+    """Returns the [project] table of path/pyproject.toml, or {} when it is missing or cannot be read"""
+    filename = os.path.join(path, 'pyproject.toml')
+    if not os.path.exists(filename):
+        return {}
+    try:
+        import tomllib
+    except ImportError:
+        try:
+            import tomli as tomllib
+        except ImportError:
+            debug('cannot read {}, tomllib or tomli is needed', filename)
+            return {}
+    with open(filename, 'rb') as f:
+        return tomllib.load(f).get('project', {})
+
+
+def recipe_metadata(source_tarball_filename, path):
+    """Returns what a conda recipe needs from the sdist (PKG-INFO, requires.txt and entry_points.txt)
+
+    Missing values are taken from the [project] table of the pyproject.toml in path.
+    """
+    import email.parser
+    files = read_sdist_files(source_tarball_filename, ['PKG-INFO', 'requires.txt', 'entry_points.txt'])
+    metadata = email.parser.Parser().parsestr(files.get('PKG-INFO', ''))
+    project = read_pyproject(path)
+    if 'requires.txt' in files:
+        requires = []
+        for line in files['requires.txt'].splitlines():
+            if line.startswith('['):  # extras and environment markers follow, not needed to run
+                break
+            if line.strip():
+                requires.append(line.strip())
+    elif metadata.get_all('Requires-Dist'):
+        requires = [k for k in metadata.get_all('Requires-Dist') if 'extra ==' not in k]
+    else:
+        requires = project.get('dependencies', [])
+    home_page = metadata.get('Home-page')
+    for url in metadata.get_all('Project-URL') or []:
+        label, _, value = url.partition(',')
+        if not home_page and label.strip().lower() in ('homepage', 'home'):
+            home_page = value.strip()
+    urls = project.get('urls', {})
+    license = project.get('license', '')
+    if isinstance(license, dict):
+        license = license.get('text', '')
+    description = metadata.get_payload() or metadata.get('Description') or ''
+    return {'Home-page': home_page or urls.get('Homepage') or urls.get('homepage') or '',
+            'License': metadata.get('License') or metadata.get('License-Expression') or license,
+            'Summary': metadata.get('Summary') or project.get('description', ''),
+            'Description': description.strip().replace('\n', '\n    '),
+            'requires': requires,
+            'entry_points': 'entry_points.txt' in files or bool(project.get('scripts') or
+                                                                 project.get('entry-points'))}
+
+
+def pypirc_credentials(repository='pypi', filename='~/.pypirc'):
+    """Returns (repository url, username, password) from the pypirc file, with None for what is missing"""
+    try:
+        import configparser
+    except ImportError:  # py2
+        import ConfigParser as configparser
+    config = configparser.RawConfigParser()
+    config.read(os.path.expanduser(filename))
+    if not config.has_section(repository):
+        return None, None, None
+    get = lambda key: config.get(repository, key) if config.has_option(repository, key) else None
+    return get('repository'), get('username'), get('password')
+
+
+class Uploader(object):
+    """Uploads distributions to a package index (like twine upload), using the legacy upload API.
+
+    Connections are kept alive and reused for all uploads, up to max_connections are used
+    when uploading from multiple threads. The multipart body is streamed from the file,
+    with the Content-Length computed up front, so files are never read into memory.
+    Credentials come from TWINE_USERNAME/TWINE_PASSWORD/TWINE_REPOSITORY_URL or ~/.pypirc.
+    """
+    default_url = 'https://upload.pypi.org/legacy/'
+    chunk_size = 1024 * 1024
+    # metadata fields that can occur multiple times, and their name in the upload form
+    multiple_fields = {'classifier': 'classifiers', 'project-url': 'project_urls', 'platform': 'platform',
+                       'supported-platform': 'supported_platform', 'requires-dist': 'requires_dist',
+                       'provides-dist': 'provides_dist', 'obsoletes-dist': 'obsoletes_dist',
+                       'requires-external': 'requires_external', 'provides-extra': 'provides_extra',
+                       'dynamic': 'dynamic'}
+
+    def __init__(self, repository_url=None, username=None, password=None, max_connections=4):
+        pypirc_username, pypirc_password = pypirc_credentials()[1:]
+        self.repository_url = upload_repository_url(repository_url)
+        username = username or os.environ.get('TWINE_USERNAME') or pypirc_username
+        password = password or os.environ.get('TWINE_PASSWORD') or pypirc_password
+        if username is None or password is None:
+            error('no credentials for {}, set TWINE_USERNAME and TWINE_PASSWORD or use ~/.pypirc',
+                  self.repository_url)
+        import base64
+        self.authorization = 'Basic ' + base64.b64encode(
+            '{}:{}'.format(username, password).encode('utf-8')).decode('ascii')
+        try:
+            from urllib.parse import urlsplit
+        except ImportError:  # py2
+            from urlparse import urlsplit
+        self.url = urlsplit(self.repository_url)
+        self.max_connections = max_connections
+        self.connections = []  # idle connections
+        self.semaphore = threading.BoundedSemaphore(max_connections)
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        try:
+            import http.client as httplib
+        except ImportError:  # py2
+            import httplib
+        connection_class = httplib.HTTPSConnection if self.url.scheme == 'https' else httplib.HTTPConnection
+        return connection_class(self.url.hostname, self.url.port, timeout=300)
+
+    @contextmanager
+    def connection(self):
+        with self.semaphore:
+            with self.lock:
+                connection = self.connections.pop() if self.connections else None
+            connection = connection or self._connect()
+            try:
+                yield connection
+            except Exception:
+                connection.close()  # the connection can be in any state, do not reuse it
+                raise
+            with self.lock:
+                self.connections.append(connection)
+
+    def form_fields(self, filename):
+        metadata = read_dist_metadata(filename)
+        digests = hash_file(filename, ('md5', 'sha256'))
+        fields = [(':action', 'file_upload'), ('protocol_version', '1'),
+                  ('md5_digest', digests['md5']), ('sha256_digest', digests['sha256'])]
+        if filename.endswith('.whl'):
+            fields += [('filetype', 'bdist_wheel'), ('pyversion', os.path.basename(filename).split('-')[-3])]
+        else:
+            fields += [('filetype', 'sdist'), ('pyversion', 'source')]
+        fields.append(('metadata_version', metadata['Metadata-Version']))
+        for key, value in metadata.items():
+            key = key.lower()
+            if key == 'metadata-version':
+                continue
+            fields.append((self.multiple_fields.get(key, key.replace('-', '_')), value))
+        description = metadata.get_payload()
+        if description and description.strip():  # since metadata 2.1 the description is the body
+            fields.append(('description', description))
+        return fields
+
+    def upload(self, filename):
+        boundary = '--------releash-' + hash_file(filename, ('sha256',))['sha256'][:32]
+        parts = []
+        for name, value in self.form_fields(filename):
+            parts.append('--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(
+                         boundary, name, value).encode('utf-8'))
+        file_header = ('--{}\r\nContent-Disposition: form-data; name="content"; filename="{}"\r\n'
+                       'Content-Type: application/octet-stream\r\n\r\n').format(
+                       boundary, os.path.basename(filename)).encode('utf-8')
+        footer = '\r\n--{}--\r\n'.format(boundary).encode('utf-8')
+        length = sum(len(k) for k in parts) + len(file_header) + os.path.getsize(filename) + len(footer)
+        for attempt in range(2):
+            try:
+                with self.connection() as connection:
+                    connection.putrequest('POST', self.url.path or '/')
+                    connection.putheader('Content-Type', 'multipart/form-data; boundary=' + boundary)
+                    connection.putheader('Content-Length', str(length))
+                    connection.putheader('Authorization', self.authorization)
+                    connection.endheaders()
+                    for part in parts:
+                        connection.send(part)
+                    connection.send(file_header)
+                    with open(filename, 'rb') as f:
+                        for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                            connection.send(chunk)
+                    connection.send(footer)
+                    response = connection.getresponse()
+                    body = response.read()  # read it all, so the connection can be reused
+                break
+            except (IOError, OSError) as e:
+                # a kept alive connection may have been closed by the server, try once with a new one
+                if attempt == 1:
+                    error('could not upload {}: {}', filename, e)
+                debug('retrying upload of {}: {}', filename, e)
+        if response.status != 200:
+            error('could not upload {}: {} {} {}', filename, response.status, response.reason,
+                  body.decode('utf-8', 'replace')[:500])
+        info('uploaded {} to {}', os.path.basename(filename), self.repository_url)
+
+
+class PackageIndex(object):
+    """Looks up which files of a version are on a package index, with the JSON API ({index_url}/{name}/{version}/json)
+
+    Responses are cached on disk with their ETag, so a repeated lookup is a conditional request
+    (If-None-Match) that the index can answer with 304 Not Modified. With offline, only the
+    cache is used, and only files found earlier count: a version that was not there may have
+    been uploaded since.
+    """
+    default_url = 'https://pypi.org/pypi'
+    threads = 16
+
+    def __init__(self, index_url=None, path=None, offline=False):
+        self.index_url = (index_url or os.environ.get('RELEASH_INDEX_URL') or self.default_url).rstrip('/')
+        self.path = path or cache_dir('index')
+        self.offline = offline
+
+    def files(self, name, version):
+        """Returns the set of filenames published for version, or None when that is not known"""
+        import hashlib
+        try:
+            from urllib.request import urlopen, Request
+            from urllib.error import HTTPError, URLError
+        except ImportError:  # py2
+            from urllib2 import urlopen, Request, HTTPError, URLError
+        url = '{}/{}/{}/json'.format(self.index_url, name, version)
+        filename = os.path.join(self.path, hashlib.sha256(url.encode('utf8')).hexdigest() + '.json')
+        cached = _read_json(filename, None)
+        cached_files = set(cached['files']) if cached else None
+        if self.offline:
+            return cached_files or None
+        headers = {'Accept': 'application/json'}
+        if cached and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        try:
+            response = urlopen(Request(url, headers=headers), timeout=30)
+            data = json.loads(response.read().decode('utf-8'))
+            files = sorted(k['filename'] for k in data.get('urls', []))
+            _write_json(filename, dict(url=url, etag=response.headers.get('ETag'), files=files))
+            return set(files)
+        except HTTPError as e:
+            if e.code == 304 and cached:
+                debug('{} not modified', url)
+                return cached_files
+            if e.code == 404:
+                _write_json(filename, dict(url=url, etag=None, files=[]))
+                return set()
+            info('could not look up {}: {}', url, e)
+        except (URLError, IOError, OSError, ValueError) as e:
+            info('could not look up {}: {}', url, e)
+        return cached_files
+
+    def lookup(self, items):
+        """Returns {(name, version): files} for all (name, version) pairs, looked up concurrently"""
+        items = sorted(set(items))
+        if len(items) <= 1 or self.offline:  # reading the cache is fast enough
+            return {item: self.files(*item) for item in items}
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(self.threads, len(items)))
+        try:
+            results = pool.map(lambda item: self.files(*item), items)
+        finally:
+            pool.close()
+        return dict(zip(items, results))
+
+
+# JSON API of the indices we know the upload url of, see index_url_for
+known_index_urls = {'https://upload.pypi.org/legacy/': 'https://pypi.org/pypi',
+                    'https://test.pypi.org/legacy/': 'https://test.pypi.org/pypi'}
+
+
+def upload_repository_url(repository_url=None):
+    """Returns the url twine and Uploader upload to: TWINE_REPOSITORY_URL, from ~/.pypirc or pypi"""
+    return repository_url or os.environ.get('TWINE_REPOSITORY_URL') or pypirc_credentials()[0] or \
+        Uploader.default_url
+
+
+def index_url_for(target):
+    """Returns the JSON API url of the index the target uploads to, or None when we do not know it
+
+    That is the index_url of the target, RELEASH_INDEX_URL, or for an upload to (test.)pypi.org its
+    JSON API. For other repositories we cannot guess it, so nothing is looked up.
+    """
+    index_url = target.index_url or os.environ.get('RELEASH_INDEX_URL')
+    if index_url:
+        return index_url
+    repository_url = upload_repository_url(getattr(target, 'repository_url', None))
+    return known_index_urls.get(repository_url.rstrip('/') + '/')
+
+
+def index_files(packages, offline=False):
+    """Returns {name: files or None (not known)}, the files of the current version of each package on its index
+
+    All packages of the same index are looked up concurrently.
+    """
+    by_index = collections.defaultdict(list)
+    for package in packages:
+        target = package.find_index_target()
+        index_url = index_url_for(target) if target is not None else None
+        if index_url is not None:
+            by_index[index_url].append(package)
+    result = {}
+    for index_url, index_packages in by_index.items():
+        items = [(package.distribution_name, safe_version(str(package.version_source))) for package in index_packages]
+        files = PackageIndex(index_url, offline=offline).lookup(items)
+        for package, item in zip(index_packages, items):
+            result[package.name] = files[item]
+    return result
+
+
+def published(packages, offline=False):
+    """Returns {name: True, False or None (not known)}, is the current version of each package on its package index"""
+    return {name: None if files is None else bool(files)
+            for name, files in index_files(packages, offline=offline).items()}
+
+
+# {(name, version): files} on the package index, looked up for all packages at once before a release
+_published_files = {}
+
+
+def lookup_published_files(packages):
+    """Looks up what is already uploaded of the packages, so release targets can skip it, see published_files
+
+    In a dry run only earlier answers are used, the index is not asked.
+    """
+    packages = list(packages)
+    files = index_files(packages, offline=dry_run)
+    for package in packages:
+        if package.name in files:
+            _published_files[package.name, str(package.version_source)] = files[package.name]
+
+
+def published_files(package):
+    """Returns the files of the current version of package on the package index (empty when not known)"""
+    return _published_files.get((package.name, str(package.version_source))) or set()
+
+
+_uploaders = {}
+_uploaders_lock = threading.Lock()
+
+
+def uploader(repository_url=None):
+    """Returns the Uploader for repository_url, shared by all targets so connections are reused"""
+    with _uploaders_lock:
+        if repository_url not in _uploaders:
+            _uploaders[repository_url] = Uploader(repository_url)
+        return _uploaders[repository_url]
 
 
 def ask(question, default):
@@ -84,7 +732,7 @@ def ask(question, default):
 def is_available(cmd):
     if verbose:
         print('test command: ', cmd)
-    return os.system(cmd + ' ' + _to_null) == 0
+    return system(cmd + ' ' + _to_null) == 0
 
 
 def debug(msg, *args, **kwargs):
@@ -106,29 +754,160 @@ def green(text):
     return formatted.format(text=text)
 
 
+_thread_state = threading.local()
+
+
+class _ThreadStdout(object):
+    """Sends output to a per thread buffer (when set), so parallel jobs do not interleave"""
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+
+    def write(self, text):
+        buffer = getattr(_thread_state, 'buffer', None)
+        return (buffer or self.stdout).write(text)
+
+    def flush(self):
+        self.stdout.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stdout, name)
+
+
+command_log = []  # one dict per command that was run, see _record
+
+
+@contextmanager
+def command_context(**context):
+    """Commands run within this context are recorded with this context (e.g. package and target name)"""
+    previous = getattr(_thread_state, 'context', {})
+    _thread_state.context = dict(previous, **context)
+    try:
+        yield
+    finally:
+        _thread_state.context = previous
+
+
+def _record(cmd, start, exit_code):
+    command_log.append(dict(getattr(_thread_state, 'context', {}), cmd=cmd, start=start,
+                            duration=time.time() - start, exit_code=exit_code,
+                            thread=threading.current_thread().name))
+
+
+def system(cmd):
+    """Like os.system, but when running in a parallel job, the output goes to the job's buffer"""
+    start = time.time()
+    buffer = getattr(_thread_state, 'buffer', None)
+    if buffer is None:
+        return_value = os.system(cmd)
+        exit_code = return_value
+        if os.name != 'nt' and hasattr(os, 'waitstatus_to_exitcode'):
+            exit_code = os.waitstatus_to_exitcode(return_value)
+        _record(cmd, start, exit_code)
+        return return_value
+    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    buffer.write(output.decode('utf-8', 'replace'))
+    _record(cmd, start, process.returncode)
+    return process.returncode
+
+
+def _buffered(func, item):
+    """Calls func(item) with the output going to a buffer, returns (result, exception, output)"""
+    _thread_state.buffer = io.StringIO()
+    try:
+        return func(item), None, _thread_state.buffer.getvalue()
+    except BaseException as e:  # error(..) raises SystemExit, which should end up in the main thread
+        return None, e, _thread_state.buffer.getvalue()
+    finally:
+        _thread_state.buffer = None
+
+
+@contextmanager
+def _thread_stdout():
+    stdout = sys.stdout
+    sys.stdout = _ThreadStdout(stdout)
+    try:
+        yield stdout
+    finally:
+        sys.stdout = stdout
+
+
+def for_each(func, items):
+    """Calls func for each item, using up to `jobs` threads.
+
+    The output of each call is buffered, and printed in the order of the items.
+    """
+    items = list(items)
+    if jobs <= 1 or interactive or len(items) <= 1:
+        return [func(item) for item in items]
+    from concurrent.futures import ThreadPoolExecutor
+
+    results = []
+    with _thread_stdout() as stdout:
+        executor = ThreadPoolExecutor(max_workers=jobs)
+        try:
+            futures = [executor.submit(_buffered, func, item) for item in items]
+            for future in futures:
+                result, exception, output = future.result()
+                stdout.write(output)
+                stdout.flush()
+                if exception is not None:
+                    for other in futures:
+                        other.cancel()
+                    raise exception
+                results.append(result)
+        finally:
+            executor.shutdown(wait=True)
+    return results
+
+
 def test(cmd):
     cmd = cmd + ' ' + _to_null
     if verbose:
         print(cmd)
-    return os.system(cmd) == 0
+    return system(cmd) == 0
 
 
-def execute(cmd):
+def capture(cmd, input=None):
+    """Runs cmd (with input as stdin) and returns (exit code, stdout), stderr is discarded"""
+    if verbose:
+        print(cmd)
+    start = time.time()
+    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                               stdin=subprocess.PIPE if input is not None else None)
+    output = process.communicate(input.encode('utf-8') if input is not None else None)[0]
+    _record(cmd, start, process.returncode)
+    return process.returncode, output.decode('utf-8', 'replace')
+
+
+def confirm(description, prompt='Run command'):
+    """Asks if description should be done when interactive (otherwise shows it unless quiet), False means no"""
     if interactive:
         while True:
-            answer = input('Run command: %s\nyes,no,quit: [y/n/q]' % cmd)
+            answer = input('%s: %s\nyes,no,quit: [y/n/q]' % (prompt, description))
             print(answer)
             if answer == 'y':
-                break
+                return True
             elif answer == 'n':
-                return
+                # counted, so a Step knows it was not (completely) done, see Step.execute
+                _thread_state.declined = getattr(_thread_state, 'declined', 0) + 1
+                return False
             elif answer == 'q':
                 sys.exit(0)
-    else:
-        if not quiet:
-            print(cmd)
+    elif not quiet:
+        print(description)
+    return True
+
+
+def execute(cmd):
+    if _plan is not None:  # compiling a plan, see Plan
+        _plan.add_command(cmd)
+        return
+    if not confirm(cmd):
+        return
     if not dry_run:
-        return_value = os.system(cmd)
+        return_value = system(cmd)
         if return_value != 0:
             error("%r exit with error code: %s" % (cmd, return_value))
 
@@ -136,23 +915,616 @@ def execute(cmd):
 def execute_always(cmd):
     if not quiet:
         print(cmd)
-    return_value = os.system(cmd)
+    return_value = system(cmd)
     if return_value != 0:
         error("%r exit with error code: %s" % (cmd, return_value))
 
 
+def execute_function(description, func, ask=True):
+    """Like execute, but for python code: calls func, or only shows description when it is a dry run
+
+    With ask=False, the user is not asked in interactive mode (for bookkeeping, not for actions).
+    """
+    if _plan is not None:
+        _plan.add(Step(description, kind='function', run=func, confirm=ask))
+        return
+    if ask and not confirm(description, 'Run'):
+        return
+    if not dry_run:
+        func()
+
+
+class WriteSession(object):
+    """Collects file edits, to apply them all at the end, or none of them.
+
+    Edits are functions that transform the content of a file. All edits of a file, from all
+    targets and packages, are applied in a single read, transform and write of that file.
+    Each file is first written to a temporary file next to it, and only when all of them are
+    written, they are moved in place with os.replace. If that fails halfway, the files already
+    replaced are restored from the original content we kept in memory.
+    """
+
+    def __init__(self):
+        self.edits = collections.OrderedDict()  # absolute filename -> list of transforms
+        self.originals = {}
+
+    def edit(self, filename, transform):
+        # setup.py and ./setup.py are the same file, so their edits should be combined
+        filename = os.path.normpath(os.path.abspath(filename))
+        self.edits.setdefault(filename, []).append(transform)
+
+    def apply(self):
+        """Returns [(filename, new content)] for all files that change"""
+        changed = []
+        for filename, transforms in self.edits.items():
+            with open(filename) as f:
+                content = self.originals[filename] = f.read()
+            for transform in transforms:
+                content = transform(content)
+            if content != self.originals[filename]:
+                changed.append((filename, content))
+        return changed
+
+    def commit(self):
+        changed = self.apply()
+        if dry_run:
+            for filename, content in changed:
+                print("would write to {}:\n{}".format(filename, content))
+            return
+        temporaries = []
+        try:
+            for filename, content in changed:
+                temporaries.append(filename + '.releash-tmp')
+                with open(temporaries[-1], 'w') as f:
+                    f.write(content)
+                shutil.copymode(filename, temporaries[-1])
+            replaced = []
+            try:
+                for (filename, content), temporary in zip(changed, temporaries):
+                    os.replace(temporary, filename)
+                    replaced.append(filename)
+            except:
+                print("oops, error occurred, restoring {}".format(', '.join(replaced)))
+                for filename in replaced:
+                    _write_atomic(filename, self.originals[filename])
+                raise
+        finally:
+            for temporary in temporaries:
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+        for filename, content in changed:
+            info('wrote to {}', filename)
+
+
+def _write_atomic(filename, content):
+    with open(filename + '.releash-tmp', 'w') as f:
+        f.write(content)
+    shutil.copymode(filename, filename + '.releash-tmp')
+    os.replace(filename + '.releash-tmp', filename)
+
+
 @contextmanager
-def backupped(filename):
-    backup = filename + '.backup'
-    shutil.copy(filename, backup)
+def write_session():
+    """Files edited with edit_file within this context are written at the end, or not at all on an error
+
+    Sessions are per thread, so targets that run in parallel do not write each other's files.
+    """
+    session = getattr(_thread_state, 'write_session', None)
+    if session is not None:  # join the outer session
+        yield session
+        return
+    _thread_state.write_session = session = WriteSession()
     try:
-        yield
-    except:
-        print("oops, error occurred, restoring backup")
-        shutil.copy(backup, filename)
-        raise
+        yield session
     finally:
-        os.remove(backup)
+        _thread_state.write_session = None
+    if _plan is not None:
+        _plan.add(Step('write ' + ', '.join(os.path.relpath(k) for k in session.edits), kind='edit',
+                       run=session.commit, files=list(session.edits), serial=True))
+    else:
+        session.commit()
+
+
+def edit_file(filename, transform):
+    """Changes filename to transform(content), part of the current write session if there is one"""
+    with write_session() as session:
+        session.edit(filename, transform)
+
+
+def _split_z(output):
+    return [k for k in output.split('\0') if k]
+
+
+class PathTrie(object):
+    """Maps paths (relative to the repo root) to the packages that own them.
+
+    Looking up the owners of a path walks its components, so it costs O(depth of the path),
+    independent of the number of packages. Nested packages both own the files of the inner one.
+    """
+
+    def __init__(self):
+        self.children = {}
+        self.values = []
+
+    @staticmethod
+    def _parts(path):
+        return [k for k in path.split('/') if k]
+
+    def insert(self, path, value):
+        node = self
+        for part in self._parts(path):
+            node = node.children.setdefault(part, PathTrie())
+        if value not in node.values:
+            node.values.append(value)
+
+    def owners(self, path):
+        """Values inserted at path, or at any of its parent directories"""
+        node = self
+        result = list(node.values)
+        for part in self._parts(path):
+            node = node.children.get(part)
+            if node is None:
+                break
+            result += node.values
+        return result
+
+    def within(self, path):
+        """Values inserted at path, or below it"""
+        node = self
+        for part in self._parts(path):
+            node = node.children.get(part)
+            if node is None:
+                return []
+        result = []
+        todo = [node]
+        while todo:
+            node = todo.pop()
+            result += node.values
+            todo += node.children.values()
+        return result
+
+
+class RepoStatus(object):
+    """Working tree state of the whole repo, gathered with a fixed number of git calls.
+
+    Instead of asking git about each package, we list all modified and untracked
+    files once, and map them back to the packages using a PathTrie. Changes since the
+    last tag of each package are found with one git diff per distinct tag commit.
+    """
+
+    def __init__(self, packages=None, cache=None):
+        self.packages = packages if packages is not None else globals()['packages']
+        self.cache = cache
+        self.published = {}  # filled in by status, see published()
+        _, prefix = capture('git rev-parse --show-prefix')
+        self.prefix = prefix.strip()
+        self.path_trie = PathTrie()
+        self.dirty_trie = PathTrie()  # uses Package.filenames when given
+        for package in self.packages:
+            self.path_trie.insert(self.repo_path(package.path), package.name)
+            for path in package.filenames or [package.path]:
+                self.dirty_trie.insert(self.repo_path(path), package.name)
+        _, output = capture('git diff --name-only --no-renames -z')
+        self.modified = _split_z(output)
+        self.dirty = set()
+        for filename in self.modified:
+            self.dirty.update(self.dirty_trie.owners(filename))
+        _, output = capture('git ls-files --other --exclude-standard --directory --full-name -z :/')
+        self.untracked = {}
+        for filename in _split_z(output):
+            filename = filename.rstrip('/')
+            # an untracked directory can also contain whole packages
+            for name in set(self.path_trie.owners(filename) + self.path_trie.within(filename)):
+                self.untracked.setdefault(name, []).append(filename)
+        self._changed = None
+        self._lock = threading.Lock()
+
+    def repo_path(self, path):
+        """Converts a path relative to the current directory to one relative to the repo root"""
+        path = os.path.normpath(os.path.join(self.prefix, os.path.relpath(path)))
+        path = path.replace(os.sep, '/')
+        return '' if path == '.' else path
+
+    def is_clean(self, package):
+        return package.name not in self.dirty
+
+    def untracked_files(self, package):
+        return self.untracked.get(package.name, [])
+
+    def tag_exists(self, package):
+        return self.changed_since_tag(package) is not None
+
+    def changed_since_tag(self, package):
+        """True when the package has changes since its tag, None when it is not tagged"""
+        with self._lock:
+            if self._changed is None:
+                self._changed = self._find_changed()
+        return self._changed.get(package.name)
+
+    def _find_changed(self):
+        changed = {}
+        todo = []
+        for package in self.packages:
+            entry = self.cache.get(package, self.repo_path(package.path)) if self.cache else None
+            if entry is None:
+                todo.append(package)
+            elif entry['tag_exists']:
+                changed[package.name] = entry['changed']
+        changed.update(self._find_changed_packages(todo))
+        if self.cache:
+            for package in todo:
+                self.cache.put(package, self.repo_path(package.path),
+                               package.name in changed, changed.get(package.name, False))
+        return changed
+
+    def _find_changed_packages(self, packages):
+        changed = {}
+        by_commit = collections.OrderedDict()
+        for package in packages:
+            tag = package.find_tag_target()
+            if tag is None or not tag.exists():
+                continue
+            changed[package.name] = False
+            by_commit.setdefault(tag_index().commit(str(tag)), []).append(package.name)
+        for commit, names in by_commit.items():
+            # without rename detection, a file moved out of a package is listed under both paths
+            _, output = capture('git diff --name-only --no-renames -z {commit}...HEAD'.format(commit=commit))
+            names = set(names)
+            for filename in _split_z(output):
+                for name in self.path_trie.owners(filename):
+                    if name in names:
+                        changed[name] = True
+        return changed
+
+
+def find_git_dir(path='.'):
+    """Returns the .git directory of the repo containing path, or None"""
+    path = os.path.abspath(path)
+    while True:
+        git = os.path.join(path, '.git')
+        if os.path.isdir(git):
+            return git
+        if os.path.isfile(git):  # worktrees and submodules have a file pointing to the git dir
+            with open(git) as f:
+                content = f.read().strip()
+            if content.startswith('gitdir:'):
+                return os.path.normpath(os.path.join(path, content[len('gitdir:'):].strip()))
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+class StatusCache(object):
+    """Stores the tag state of each package in .git/releash-status.json between runs.
+
+    The tag state (does the tag exist, are there changes since the tag) only depends on the
+    commits and the refs, so the cache is keyed by the HEAD commit, the checksum of packed-refs
+    and the loose tags. Entries of packages whose tag name or path changed are recomputed.
+    The working tree state is not cached: editing a file does not change any of these keys.
+    """
+    filename = 'releash-status.json'
+    format = 2  # changing this invalidates existing caches (2: renames are no longer detected)
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        # in a worktree, refs are shared with the main repo
+        self.common_dir = git_dir
+        if os.path.exists(os.path.join(git_dir, 'commondir')):
+            with open(os.path.join(git_dir, 'commondir')) as f:
+                self.common_dir = os.path.normpath(os.path.join(git_dir, f.read().strip()))
+        self.path = os.path.join(git_dir, self.filename)
+        self.key = self._key()
+        data = _read_json(self.path, {})
+        self.entries = data.get('packages', {}) if data.get('key') == self.key else {}
+        self.changed = False
+
+    def _read_ref(self, ref):
+        filename = os.path.join(self.common_dir, *ref.split('/'))
+        if os.path.exists(filename):
+            with open(filename) as f:
+                return f.read().strip()
+        packed_refs = os.path.join(self.common_dir, 'packed-refs')
+        if os.path.exists(packed_refs):
+            with open(packed_refs) as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 2 and parts[1] == ref:
+                        return parts[0]
+
+    def _key(self):
+        with open(os.path.join(self.git_dir, 'HEAD')) as f:
+            head = f.read().strip()
+        if head.startswith('ref:'):
+            head = self._read_ref(head[len('ref:'):].strip())
+        packed_refs = os.path.join(self.common_dir, 'packed-refs')
+        packed_refs_hash = hash_file(packed_refs, ('sha1',))['sha1'] if os.path.exists(packed_refs) else None
+        loose_tags = []
+        for root, dirs, files in os.walk(os.path.join(self.common_dir, 'refs', 'tags')):
+            for name in files:
+                filename = os.path.join(root, name)
+                loose_tags.append([os.path.relpath(filename, self.common_dir), os.stat(filename).st_mtime])
+        return [self.format, head, packed_refs_hash, sorted(loose_tags)]
+
+    def _inputs(self, package, repo_path):
+        tag = package.find_tag_target()
+        return [str(tag) if tag else None, repo_path]
+
+    def get(self, package, repo_path):
+        """Returns {'tag_exists': .., 'changed': ..} for the package, or None"""
+        entry = self.entries.get(package.name)
+        if entry is not None and entry['inputs'] == self._inputs(package, repo_path):
+            return entry
+
+    def put(self, package, repo_path, tag_exists, changed):
+        self.entries[package.name] = dict(inputs=self._inputs(package, repo_path),
+                                          tag_exists=tag_exists, changed=changed)
+        self.changed = True
+
+    def save(self):
+        if self.changed and not dry_run:
+            _write_json(self.path, dict(key=self.key, packages=self.entries))
+
+
+class TagIndex(object):
+    """All tags of the repo, read with a single git for-each-ref.
+
+    Maps tag names to the commit they point to, so looking up a tag does not
+    require a git call per package.
+    """
+
+    def __init__(self):
+        self.tags = {}
+        cmd = 'git for-each-ref --format="%(refname:strip=2) %(objectname) %(*objectname)" refs/tags'
+        _, output = capture(cmd)
+        for line in output.splitlines():
+            parts = line.split(' ')
+            if len(parts) == 3:
+                name, sha, peeled = parts
+                # annotated tags are peeled to the commit they point to
+                self.tags[name] = peeled or sha
+
+    def __contains__(self, tag):
+        return tag in self.tags
+
+    def commit(self, tag):
+        """Returns the commit of the tag, or the tag name itself when we created it this run"""
+        return self.tags.get(tag) or tag
+
+    def add(self, tag, sha=None):
+        self.tags[tag] = sha
+
+
+_tag_index = None
+_tag_index_lock = threading.Lock()
+
+
+def tag_index():
+    global _tag_index
+    with _tag_index_lock:
+        if _tag_index is None:
+            _tag_index = TagIndex()
+    return _tag_index
+
+
+class GitBatch(object):
+    """Collects the files and messages of git_commit calls, to make a single commit"""
+
+    def __init__(self):
+        self.filenames = []
+        self.messages = []
+
+    def add(self, filenames):
+        self.filenames += [k for k in filenames if k not in self.filenames]
+
+    def commit(self):
+        if not self.messages:
+            return
+        previous = last_commit()
+        execute('git add {files}'.format(files=' '.join(self.filenames)))
+        if len(self.messages) == 1:
+            execute('git commit -m "{msg}"'.format(msg=self.messages[0]))
+        else:
+            # one paragraph per package in the commit message
+            execute('git commit -m "🔖 {count} packages released" {body}'.format(
+                count=len(self.messages), body=' '.join('-m "%s"' % k for k in self.messages)))
+        remember_commit('{} packages'.format(len(self.messages)), previous)
+
+
+class CommitRef(object):
+    """The commit a tag should point to, known once the commit is made (see TagBatch)"""
+
+    def __init__(self, previous=None):
+        self.sha = None
+        self.previous = previous
+        self.made = True
+
+    def resolve(self):
+        exit_code, output = capture('git rev-parse HEAD')
+        if exit_code != 0:
+            error('could not find the HEAD commit')
+        self.sha = output.strip()
+        # HEAD did not move when the user said no to the commit (or there was nothing to commit)
+        self.made = self.previous is None or self.previous.sha != self.sha
+
+
+def last_commit():
+    """Returns the CommitRef of the last git_commit, or of the current HEAD when nothing was committed"""
+    global _last_commit
+    if _last_commit is None:
+        _last_commit = CommitRef()
+        _last_commit.resolve()
+    return _last_commit
+
+
+_git_batch = None
+_last_commit = None  # CommitRef of the last git_commit, tags requested after it point to that commit
+
+
+def remember_commit(what, previous):
+    """Records HEAD after a commit (when it is made, so also when the user did not want to commit)"""
+    global _last_commit
+    _last_commit = ref = CommitRef(previous)
+    execute_function('remember the commit of {}'.format(what), ref.resolve, ask=False)
+
+
+def git_commit(msg, filenames=()):
+    """Commits filenames (only those, when given), or adds them to the current single_commit"""
+    if _git_batch is not None:
+        _git_batch.add(filenames)
+        _git_batch.messages.append(msg)
+    else:
+        previous = last_commit()  # before committing, HEAD is only read now when nothing was committed yet
+        if filenames:
+            execute('git add {files}'.format(files=' '.join(filenames)))
+            execute('git commit -m "{msg}" -- {files}'.format(msg=msg, files=' '.join(filenames)))
+        else:
+            execute('git commit -m "{msg}"'.format(msg=msg))
+        remember_commit(msg, previous)
+
+
+@contextmanager
+def single_commit():
+    """All git_commit calls within this context result in one git add and one git commit"""
+    global _git_batch
+    _git_batch = batch = GitBatch()
+    try:
+        yield batch
+    finally:
+        _git_batch = None
+    batch.commit()
+
+
+class TagBatch(object):
+    """Collects tags, to create them all at once with a fixed number of git calls.
+
+    Tag objects are written with a single git hash-object, and the refs are created with a single
+    git update-ref --stdin, which is one transaction: either all tags are created, or none.
+    Since commits can be made after a tag is requested, each tag refers to the CommitRef of the last
+    commit before its request, which records HEAD right after that commit was made.
+    """
+
+    def __init__(self):
+        self.tags = []  # (name, message or None for a lightweight tag, CommitRef)
+
+    def add(self, name, message):
+        self.tags.append((name, message, last_commit()))
+
+    def flush(self):
+        tags, self.tags = self.tags, []
+        if not tags:
+            return
+        if _plan is not None:
+            batch = TagBatch()
+            batch.tags = tags
+            _plan.add(Step('create tags ' + ', '.join(k[0] for k in tags), kind='tag', run=batch.flush, serial=True,
+                           confirm=True))
+            return
+        if any(commit.sha is None for name, message, commit in tags):
+            error('could not find the commits to tag')
+        for name, message, commit in tags:
+            if not commit.made:
+                info('not creating tag {}, its commit was not made', name)
+        tags = [k for k in tags if k[2].made]
+        if not tags:
+            return
+        refs = [(name, commit.sha) for name, message, commit in tags]
+        annotated = [i for i, (name, message, commit) in enumerate(tags) if message is not None]
+        if annotated:
+            objects = self._write_tag_objects([(refs[i][0], refs[i][1], tags[i][1]) for i in annotated])
+            for i, sha in zip(annotated, objects):
+                refs[i] = (refs[i][0], sha)
+        verb = 'update' if force else 'create'  # create fails if the tag exists, like git tag without -f
+        updates = ''.join('{verb} refs/tags/{name} {sha}\n'.format(verb=verb, name=name, sha=sha) for name, sha in refs)
+        info('creating tags: {}', ', '.join(name for name, sha in refs))
+        exit_code, output = capture('git update-ref --stdin', input=updates)
+        if exit_code != 0:
+            error('could not create tags {} (none were created)', ', '.join(name for name, sha in refs))
+        if _tag_index is not None:  # otherwise the index will see them when it is read
+            for name, message, commit in tags:
+                _tag_index.add(name, commit.sha)
+
+    def _write_tag_objects(self, tags):
+        import tempfile
+        exit_code, tagger = capture('git var GIT_COMMITTER_IDENT')
+        if exit_code != 0:
+            error('could not find the tagger identity, please configure user.name and user.email')
+        directory = tempfile.mkdtemp()
+        try:
+            filenames = []
+            for i, (name, commit, message) in enumerate(tags):
+                filenames.append(os.path.join(directory, str(i)))
+                with open(filenames[-1], 'w') as f:
+                    f.write('object {commit}\ntype commit\ntag {name}\ntagger {tagger}\n\n{message}\n'.format(
+                            commit=commit, name=name, tagger=tagger.strip(), message=message))
+            exit_code, output = capture('git hash-object -t tag -w --stdin-paths',
+                                        input=''.join(k + '\n' for k in filenames))
+        finally:
+            shutil.rmtree(directory)
+        objects = output.split()
+        if exit_code != 0 or len(objects) != len(tags):
+            error('could not create tag objects for {}', ', '.join(k[0] for k in tags))
+        return objects
+
+
+_tag_batch = None
+tags_to_push = []  # tags of the packages released/tagged in this run, see ReleaseTargetGitPush
+
+
+def push_tag(name):
+    if name not in tags_to_push:
+        tags_to_push.append(name)
+
+
+def flush_tags():
+    if _tag_batch is not None:
+        _tag_batch.flush()
+
+
+@contextmanager
+def tag_batch():
+    """Tags requested within this context are created in bulk at the end (or before a push)"""
+    global _tag_batch
+    _tag_batch = batch = TagBatch()
+    try:
+        yield batch
+    finally:
+        _tag_batch = None
+    batch.flush()
+
+
+_literals_cache = {}
+
+
+def read_python_literals(filename):
+    """Returns {name: value} for all top level assignments of literals in a python file.
+
+    The file is parsed, not executed, so there are no import side effects. Results are cached
+    by path, size and modification time.
+    """
+    import ast
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+    if key not in _literals_cache:
+        values = {}
+        with open(filename) as f:
+            tree = ast.parse(f.read(), filename)
+        for node in tree.body:
+            if isinstance(node, ast.Assign):
+                targets = node.targets
+            elif isinstance(node, ast.AnnAssign) and node.value is not None:
+                targets = [node.target]
+            else:
+                continue
+            try:
+                value = ast.literal_eval(node.value)
+            except ValueError:
+                continue
+            for target in targets:
+                if isinstance(target, ast.Name):
+                    values[target.id] = value
+        _literals_cache[key] = values
+    return _literals_cache[key]
 
 
 # TODO: use OrderedDict
@@ -174,9 +1546,14 @@ class VersionSource(object):
         self.bumped = False
 
     def find_version(self):
-        self.version_module = imp.load_source('version', self.version_file)
-        self.version = getattr(self.version_module, self.tuple_variable_name)
-        self.semver = semver.parse(str(self))
+        values = read_python_literals(self.version_file)
+        if self.tuple_variable_name not in values:
+            # not a literal, so we need to run the file
+            import runpy
+            values = runpy.run_path(self.version_file)
+        if self.tuple_variable_name not in values:
+            error('no variable {} found in {}', self.tuple_variable_name, self.version_file)
+        self.version = values[self.tuple_variable_name]
         self.version_previous = self.version
         # version_string = self.version_module.__version__
         # semver_string = semver.format_version(*self.version)
@@ -184,8 +1561,13 @@ class VersionSource(object):
         #     error('semver formats your version as %r, while you format it as %r, please fix this'
         #           % (semver_string, version_string))
 
+    @property
+    def semver(self):
+        import semver
+        return semver.parse(str(self))
+
     def __str__(self):
-        return semver.format_version(*self.version)
+        return format_version(*self.version)
 
     def print(self, indent=0):
         print("\t" * indent + "version: {version}".format(**self.__dict__))
@@ -200,7 +1582,9 @@ class VersionSource(object):
         else:
             what, what_name = what, None
 
-        old = semver.format_version(*self.version)
+        import semver
+        semver_bump = _semver_bump()
+        old = format_version(*self.version)
         types = ['major', 'minor', 'patch', 'prerelease', 'build']
         if what == "last":
             # count how many non None parts there are
@@ -257,29 +1641,20 @@ class VersionSourceAndTargetHpp(VersionSource):
         self.version = [k for k in version if k is not None]
 
     def save(self):
-        newlines = []
-        with open(self.version_file) as f:
-            for linenr, line in enumerate(f.readlines()):
-                newlines.append(line)
-                original_line = line
-                line = line.strip().lower()
-                for i, pattern in enumerate(self.patterns):
-                    if line.startswith(pattern):
-                        newlines[linenr] = original_line[
-                            :len(pattern)] + ' ' + str(self.version[i]) + '\n'
-
-        if not dry_run:
-            with backupped(self.version_file):
-                with open(self.version_file, 'w') as f:
-                    f.write(''.join(newlines))
-        else:
-            print("would write\n:" + ''.join(newlines))
-        info('wrote to {}', self.version_file)
-        execute('git commit -m "Release {version}"'.format(
-            version=self.version_source))
+        edit_file(self.version_file, self.update)
+        self.package.stage(self.version_file)
 
-import json
-import collections
+    def update(self, content):
+        newlines = []
+        for linenr, line in enumerate(content.splitlines(True)):
+            newlines.append(line)
+            original_line = line
+            line = line.strip().lower()
+            for i, pattern in enumerate(self.patterns):
+                if line.startswith(pattern):
+                    newlines[linenr] = original_line[
+                        :len(pattern)] + ' ' + str(self.version[i]) + '\n'
+        return ''.join(newlines)
 
 class VersionTargetJson(object):
     def __init__(self, package, json_file, key='version', indent=2):
@@ -292,8 +1667,11 @@ class VersionTargetJson(object):
     def save(self):
         if self.version_source is None:
             error('no version set')
-        with open(self.json_file, 'r') as f:
-            values = json.JSONDecoder(object_pairs_hook=collections.OrderedDict).decode(f.read())
+        edit_file(self.json_file, self.update)
+        self.package.stage(self.json_file)
+
+    def update(self, content):
+        values = json.JSONDecoder(object_pairs_hook=collections.OrderedDict).decode(content)
         value = values
         names = self.key.split('.')
         head = names[-1]
@@ -301,16 +1679,7 @@ class VersionTargetJson(object):
         for name in tail:
             value = values[name]
         value[head] = str(self.version_source)
-        dump = json.dumps(values, indent=self.indent)
-        if not dry_run:
-            with backupped(self.json_file):
-                with open(self.json_file, 'w') as f:
-                    f.write(dump)
-        else:
-            print("would write:\n" + dump)
-        info('wrote to {}', self.json_file)
-        execute('git commit -m "Release {version}" {files}'.format(
-            version=self.version_source, files=self.json_file))
+        return json.dumps(values, indent=self.indent)
 
 
 
@@ -344,26 +1713,21 @@ class VersionTarget(object):
     def save(self):
         if self.version_source is None:
             error('no version set')
+        edit_file(self.version_file, self.update)
+        self.package.stage(self.version_file)
+
+    def update(self, content):
         newlines = []
-        with open(self.version_file) as f:
-            lines = f.readlines()
-            for line in lines:
-                if re.match(self.string_variable_name + '.*', line):
-                    newlines.append(self.string_variable_name + ' = %r\n' %
-                                    str(self.version_source))
-                elif re.match(self.tuple_variable_name + '.*', line):
-                    newlines.append(self.tuple_variable_name + ' = %r\n' %
-                                    (tuple(self.version_source.version),))
-                else:
-                    newlines.append(line)
-        if not dry_run:
-            with backupped(self.version_file):
-                with open(self.version_file, 'w') as f:
-                    f.write(''.join(newlines))
-        else:
-            print("would write:\n" + ''.join(newlines))
-        info('wrote to {}', self.version_file)
-        execute('git add {files}'.format(files=self.version_file))
+        for line in content.splitlines(True):
+            if re.match(self.string_variable_name + '.*', line):
+                newlines.append(self.string_variable_name + ' = %r\n' %
+                                str(self.version_source))
+            elif re.match(self.tuple_variable_name + '.*', line):
+                newlines.append(self.tuple_variable_name + ' = %r\n' %
+                                (tuple(self.version_source.version),))
+            else:
+                newlines.append(line)
+        return ''.join(newlines)
 
 
 
@@ -385,25 +1749,19 @@ class VersionTargetReplace(object):
     def save(self):
         if self.version_source is None:
             error('no version set')
+        for filename in self.targets:
+            # all edits to the same file (by other targets or packages) are applied in one go
+            edit_file(filename, self.update)
+        self.package.stage(*self.targets)
+
+    def update(self, content):
         pattern = self.pattern.format(name=self.package.name)
         replacement = self.replacement.format(name=self.package.name, version=str(self.version_source))
-        for filename in self.targets:
-            with open(filename) as f:
-                content = f.read()
-            content_new = re.sub(pattern, replacement, content)
-            if content != content_new:
-                if not dry_run:
-                    with backupped(filename):
-                        with open(filename, "w") as f:
-                            f.write(content_new)
-                    print(f"{filename} updated")
-                else:
-                    print("would write:\n" + ''.join(content_new))
-                info('wrote to {}', filename)
-        execute('git add {files}'.format(files=' '.join(self.targets)))
+        return re.sub(pattern, replacement, content)
 
 
 class ReleaseTargetGitTagVersion(object):
+    serial = True  # tags are created one after the other, never in parallel
 
     def __init__(self, version_source, prefix='v', postfix='', annotate=True, msg='Release {version}'):
         self.version_source = version_source
@@ -417,20 +1775,20 @@ class ReleaseTargetGitTagVersion(object):
         return self.prefix + str(self.version_source) + self.postfix
 
     def py_normalized(self):
-        return pkg_resources.safe_version(str(self))
+        return safe_version(str(self))
 
     def exists(self):
-        return test('git rev-parse {tag}'.format(tag=str(self)))
+        return str(self) in tag_index()
 
     def clean_since(self, path=''):
-        version_tag = str(self)
+        version_tag = tag_index().commit(str(self))
         return test('git diff --exit-code {version_tag}...HEAD {path}'.format(path=path, version_tag=version_tag))
 
     def diff(self, path=''):
-        version_tag = str(self)
+        version_tag = tag_index().commit(str(self))
         cmd = 'git diff --exit-code {version_tag}...HEAD {path}'.format(path=path, version_tag=version_tag)
         print(cmd)
-        return os.system(cmd)
+        return system(cmd)
 
     def do(self, last_package):
         if self.tagged:
@@ -450,29 +1808,86 @@ class ReleaseTargetGitTagVersion(object):
             cmd += " -f"
         if dry_run:
             print(cmd)
+        elif _tag_batch is not None and (self.msg is not None or not self.annotate):
+            # git tag -m implies -a, without a message git tag -a would ask for one
+            _tag_batch.add(tag, self.msg.format(version=self.version_source) if self.msg is not None else None)
         else:
             execute(cmd)
+            if _tag_index is not None:
+                _tag_index.add(tag)
         self.tagged = True
+        push_tag(tag)
 
 class ReleaseTargetSourceDist:
 
-    def __init__(self, package, universal_wheel=False):
+    def __init__(self, package, universal_wheel=False, build_cache=True, upload=True, index_url=None):
         self.package = package
         self.universal_wheel = universal_wheel
+        self.build_cache = build_cache
+        self.upload = upload  # set to False when uploading with ReleaseTargetUpload
+        self.index_url = index_url  # to check what is already uploaded, see index_url_for
 
     def do(self, last_package):
-        cmd = "cd {path} && python setup.py sdist".format(
-            **self.package.__dict__)
-        execute(cmd)
+        # always build, later targets (like ReleaseTargetCondaForge) may need the files
+        commands = ["cd {path} && python setup.py sdist".format(**self.package.__dict__)]
         if self.universal_wheel:
-            cmd = "cd {path} && python setup.py bdist_wheel --universal".format(
-                **self.package.__dict__)
-            execute(cmd)
+            commands.append("cd {path} && python setup.py bdist_wheel --universal".format(
+                **self.package.__dict__))
+        cache = BuildCache() if self.build_cache else None
+        key = cache.key(self.package.path, commands) if cache else None
+        if key and cache.get(key):
+            dist_path = os.path.join(self.package.path, 'dist')
+            execute_function('copy cached build {} of {} to {}'.format(key[:12], self.package.name, dist_path),
+                             lambda: cache.restore(key, dist_path))
+        else:
+            for cmd in commands:
+                execute(cmd)
+            if key:
+                import glob
+                execute_function('store build {} of {} in the build cache'.format(key[:12], self.package.name),
+                                 lambda: cache.store(key, glob.glob(self.package.python_package_dist_files())))
+        if not self.upload:
+            return
+        files = published_files(self.package)
+        extensions = ['.tar.gz'] + (['.whl'] if self.universal_wheel else [])
+        if all(any(k.endswith(extension) for k in files) for extension in extensions):
+            info('{} {} is already on the package index, not uploading', self.package.distribution_name,
+                 safe_version(str(self.package.version_source)))
+            return
         source_tarball_filename = self.package.python_package_dist_files(absolute=False)
         cmd = "cd {path} && twine upload dist/{source_tarball_filename}".format(**self.package.__dict__,
             source_tarball_filename=source_tarball_filename)
         execute(cmd)
 
+
+class ReleaseTargetUpload:
+    """Uploads the sdist and wheels of the package from releash itself, instead of using twine
+
+    Use with ReleaseTargetSourceDist(package, upload=False). All packages share the connections
+    to the package index.
+    """
+
+    def __init__(self, package, repository_url=None, index_url=None):
+        self.package = package
+        self.repository_url = repository_url
+        self.index_url = index_url  # to check what is already uploaded, see index_url_for
+
+    def do(self, last_package):
+        def upload():
+            import glob
+            filenames = sorted(k for k in glob.glob(self.package.python_package_dist_files())
+                               if k.endswith(('.tar.gz', '.zip', '.whl')))
+            files = published_files(self.package)
+            if not filenames and not files:
+                error('no files to upload for {}', self.package.name)
+            for filename in filenames:
+                if os.path.basename(filename) in files:
+                    info('{} is already on the package index', os.path.basename(filename))
+                else:
+                    uploader(self.repository_url).upload(filename)
+        execute_function('upload {} to {}'.format(self.package.python_package_dist_files(),
+                         self.repository_url or 'the package index'), upload)
+
 class ReleaseTargetNpm:
 
     def __init__(self, package):
@@ -484,6 +1899,7 @@ class ReleaseTargetNpm:
         execute(cmd)
 
 class ReleaseTargetGitPush:
+    serial = True
 
     def __init__(self, repository='', refspec=''):
         self.repository = repository
@@ -492,19 +1908,45 @@ class ReleaseTargetGitPush:
     def do(self, last_package):
         if not last_package:
             return
+        flush_tags()
+        repository, refspec = self.repository, self.refspec
+        tags = ' '.join('refs/tags/' + k for k in tags_to_push)
+        if not refspec or (tags and not repository):
+            # git push needs the remote when we give refspecs, and the branch should always be pushed
+            # (the tags point to its release commits), use the upstream of the current branch
+            upstream_repository, upstream = self.upstream()
+            repository = repository or upstream_repository
+            if not refspec and upstream:
+                refspec = 'HEAD:' + upstream
+        # only the tags of this run, git push --tags would compare all tags with the remote
+        cmd = "git push {repository} {refspec} {tags}"
         if force:
-            cmd = "git push {repository} {refspec} --force && git push {repository} --tags --force"
-        else:
-            cmd = "git push {repository} {refspec} && git push {repository} --tags"
-        execute(cmd.format(repository=self.repository, refspec=self.refspec))
+            cmd += " --force"
+        execute(cmd.format(repository=repository, refspec=refspec, tags=tags))
+
+    def upstream(self):
+        """Returns the remote and remote branch of the current branch
+
+        Without an upstream, this is origin and the branch with the same name, with a detached
+        HEAD the branch is None.
+        """
+        exit_code, branch = capture('git symbolic-ref -q HEAD')
+        if exit_code != 0:
+            return 'origin', None
+        branch = branch.strip()
+        cmd = 'git for-each-ref --format="%(upstream:remotename) %(upstream:remoteref)" {branch}'
+        exit_code, output = capture(cmd.format(branch=branch))
+        parts = output.split()
+        if exit_code == 0 and len(parts) == 2:
+            return parts[0], parts[1]
+        return 'origin', branch
 
 
 def replace_in_file(filename, *replacements):
-    newlines = []
-    found = [False] * len(replacements)
-    with open(filename) as f:
-        lines = f.readlines()
-        for line in lines:
+    def update(content):
+        newlines = []
+        found = [False] * len(replacements)
+        for line in content.splitlines(True):
             replacement_done = False
             for i, (regex, replacement) in enumerate(replacements):
                 if re.match(regex, line):
@@ -518,28 +1960,45 @@ def replace_in_file(filename, *replacements):
                     replacement_done = True
             if not replacement_done:
                 newlines.append(line)
-    for i, (regex, replacement) in enumerate(replacements):
-        if not found[i]:
-            error('{} -> {} not found in file {}',
-                  regex, replacement, filename)
-
-    content = ''.join(newlines)
-    if not dry_run:
-        with backupped(filename):
-            with open(filename, 'w') as f:
-                f.write(content)
-    else:
-        info('would write: \n{}', content)
+        for i, (regex, replacement) in enumerate(replacements):
+            if not found[i]:
+                error('{} -> {} not found in file {}',
+                      regex, replacement, filename)
+        return ''.join(newlines)
+    edit_file(filename, update)
     print('updating', filename)
 
 
+_feedstock_fetches = {}
+_feedstock_fetches_lock = threading.Lock()
+
+
+def fetch_feedstock(feedstock_path, remote='upstream'):
+    """Fetches remote in the feedstock checkout, only once per run, also when called from multiple threads"""
+    key = (os.path.abspath(feedstock_path), remote)
+    with _feedstock_fetches_lock:
+        fetch = _feedstock_fetches.setdefault(key, dict(lock=threading.Lock(), done=False))
+    with fetch['lock']:  # updates of the same feedstock wait for the fetch
+        if not fetch['done']:
+            execute('cd {} && git fetch {}'.format(feedstock_path, remote))
+            fetch['done'] = True
+
+
 class ReleaseTargetCondaForge:
+    """Updates the conda-forge feedstock and opens a pull request
 
-    def __init__(self, package, feedstock_path, source_tarball_filename=None):
+    feedstock_path is a clone of the feedstock with the remotes upstream (conda-forge) and origin (a fork).
+    It is only fetched, each update is done in its own worktree of it, which is removed afterwards,
+    so feedstocks can be updated in parallel and the checkout at feedstock_path is never changed.
+    """
+    plannable = False  # needs the built tarball to compute the hash
+
+    def __init__(self, package, feedstock_path, source_tarball_filename=None, upstream_branch='master'):
         self.package = package
         self.feedstock_path = feedstock_path
         self.branch = 'update_to_' + str(self.package.version_source)
         self.source_tarball_filename = source_tarball_filename
+        self.upstream_branch = upstream_branch
 
     def do(self, last_package):
         source_tarball_filename = self.source_tarball_filename
@@ -547,7 +2006,7 @@ class ReleaseTargetCondaForge:
         if self.source_tarball_filename is None:
             # this is what setuptools does
             version_unnormalized = str(self.package.version_source)
-            version_normalized = pkg_resources.safe_version(
+            version_normalized = safe_version(
                 version_unnormalized)
             version = version_normalized
             debug('normalized version from {} to {}',
@@ -556,55 +2015,55 @@ class ReleaseTargetCondaForge:
                          '-' + version_normalized + '.tar.gz')
 
         if source_tarball_filename.startswith('http'):
-            fileno, filename = tempfile.mkstemp()
-            info('will download {} to {}',
-                  self.source_tarball_filename, filename)
-            download(self.source_tarball_filename, filename)
-            source_tarball_filename = filename
+            info('will download {}', self.source_tarball_filename)
+            source_tarball_filename = download(self.source_tarball_filename)
 
         expect_file(source_tarball_filename)
-        with open(source_tarball_filename, 'rb') as f:
-            hash_sha256 = hashlib.sha256(f.read()).hexdigest()
-
-        # put repo in a good state
-        cmd = "cd {feedstock_path} && git stash && git checkout master &&  git pull upstream master".format(
-            **self.__dict__)
-        execute(cmd)
-
-        cmd = "cd {feedstock_path} && git checkout -b {branch}".format(
-            **self.__dict__)
+        hash_sha256 = hash_file(source_tarball_filename)['sha256']
+
+        fetch_feedstock(self.feedstock_path)
+        worktree = os.path.join(cache_dir('worktrees'), '{}-{}'.format(
+            os.path.basename(os.path.abspath(self.feedstock_path)), self.branch))
+        if os.path.exists(worktree):  # left behind by a run that was killed
+            shutil.rmtree(worktree)
+            execute('cd {} && git worktree prune'.format(self.feedstock_path))
+        cmd = "cd {feedstock_path} && git worktree add -B {branch} {worktree} upstream/{upstream_branch}".format(
+            worktree=worktree, **self.__dict__)
         execute(cmd)
+        try:
+            debug('sha256 = {}', hash_sha256)
 
-        debug('sha256 = {}', hash_sha256)
-
-        filename = os.path.join(self.feedstock_path, 'recipe', 'meta.yaml')
-        replace_in_file(filename,
-                        ('  number:.*', '  number: 0'),
-                        ('{% set version =', '{%% set version = "%s" %%}' % version),
-                        ('{% set sha256 =', '{%% set sha256 = "%s" %%}' % hash_sha256))
+            filename = os.path.join(worktree, 'recipe', 'meta.yaml')
+            replace_in_file(filename,
+                            ('  number:.*', '  number: 0'),
+                            ('{% set version =', '{%% set version = "%s" %%}' % version),
+                            ('{% set sha256 =', '{%% set sha256 = "%s" %%}' % hash_sha256))
 
-        cmd = 'cd {feedstock_path} && git commit -am "Update to version {version}"'.format(
-            version=version, **self.__dict__)
-        execute(cmd)
+            cmd = 'cd {worktree} && git commit -am "Update to version {version}"'.format(
+                worktree=worktree, version=version)
+            execute(cmd)
 
-        cmd = 'cd {feedstock_path} && git push origin {branch}'.format(
-            **self.__dict__)
-        execute(cmd)
+            cmd = 'cd {worktree} && git push origin {branch}'.format(
+                worktree=worktree, **self.__dict__)
+            execute(cmd)
 
-        cmd = 'cd {feedstock_path} && hub pull-request -m "Update to version {version}"'.format(
-            version=version, **self.__dict__)
+            cmd = 'cd {worktree} && hub pull-request -m "Update to version {version}"'.format(
+                worktree=worktree, version=version)
 
-        if is_available('hub --help'):
-            execute(cmd)
-        else:
-            print("*** the command line tool 'hub' is not aviable, so could not execute:")
-            print(cmd)
-            print('*** please do the pull request manually')
+            if is_available('hub --help'):
+                execute(cmd)
+            else:
+                print("*** the command line tool 'hub' is not aviable, so could not execute:")
+                print(cmd)
+                print('*** please do the pull request manually')
+        finally:
+            execute('cd {} && git worktree remove --force {}'.format(self.feedstock_path, worktree))
 
 
 class Package:
 
-    def __init__(self, path, name, distribution_name=None, package_name=None, version_source=None, version_targets=None, filenames=None):
+    def __init__(self, path, name, distribution_name=None, package_name=None, version_source=None, version_targets=None, filenames=None,
+                 dependencies=None):
         self.path = path
         self.abspath = os.path.abspath(path)
         self.name = name
@@ -619,10 +2078,25 @@ class Package:
         self.release_targets = []
         self.tag_targets = []
         self.filenames = filenames # files to track to see if dirty
+        self.changed_files = []  # files written by the version targets, but not committed yet
+        self.dependencies = dependencies # names of packages this depends on, None means from setup.py
+
+    def get_dependencies(self):
+        """Names of the packages this package depends on, by default found from install_requires in setup.py"""
+        if self.dependencies is None:
+            self.dependencies = []
+            setup_py = os.path.join(self.path, 'setup.py')
+            if os.path.exists(setup_py):
+                distributions = {_normalize_name(k.distribution_name): k.name for k in packages}
+                for requirement in setup_py_requirements(setup_py):
+                    name = distributions.get(_requirement_name(requirement))
+                    if name is not None and name != self.name:
+                        self.dependencies.append(name)
+        return self.dependencies
 
     def python_package_dist_files(self, absolute=True):
         version_unnormalized = str(self.version_source)
-        version_normalized = pkg_resources.safe_version(version_unnormalized)
+        version_normalized = safe_version(version_unnormalized)
         version = version_normalized
         if absolute:
             source_tarball_filename = os.path.join(self.path, 'dist', self.distribution_name +
@@ -639,67 +2113,104 @@ class Package:
               "package_name: {package_name}".format(**self.__dict__))
         print("\t" * indent + "version: ")
         self.version_source.print(indent=indent + 1)
+        if self.get_dependencies():
+            print("\t" * indent + "dependencies: " + ", ".join(self.get_dependencies()))
 
-    def release(self, last_package):
+    def release(self, last_package, serial=None):
+        """Runs the release targets, or only the (non) serial ones when serial is True (False)"""
+        for tag_target in self.tag_targets:
+            # the tag may be created by an earlier bump, it should be pushed with this release
+            if isinstance(tag_target, ReleaseTargetGitTagVersion) and (tag_target.tagged or tag_target.exists()):
+                push_tag(str(tag_target))
         for release_target in self.release_targets:
-            release_target.do(last_package=last_package)
+            target_serial = getattr(release_target, 'serial', False)
+            if serial is None or target_serial == serial:
+                with command_context(package=self.name, target=type(release_target).__name__, serial=target_serial):
+                    if _plan is not None and not getattr(release_target, 'plannable', True):
+                        # this target needs the results of earlier steps to decide what to do
+                        _plan.add(Step('{} for {}'.format(type(release_target).__name__, self.name), kind='target',
+                                       run=lambda target=release_target: target.do(last_package=last_package)))
+                    else:
+                        release_target.do(last_package=last_package)
+
+    def find_tag_target(self):
+        """Returns the tag target (from tag_targets, or else release_targets), or None"""
+        # this should move as well, too git specific
+        for targets in [self.tag_targets, self.release_targets]:
+            tag = [k for k in targets if isinstance(k, ReleaseTargetGitTagVersion)]
+            if tag:
+                return tag[0]
+
+    def find_index_target(self):
+        """Returns the release target that uploads to a package index, or None"""
+        for target in self.release_targets:
+            if isinstance(target, ReleaseTargetUpload) or \
+               (isinstance(target, ReleaseTargetSourceDist) and target.upload):
+                return target
 
     def get_tag_target(self):
-        # this should move as well, too git specific
-        tag = [k for k in self.tag_targets if isinstance(
-            k, ReleaseTargetGitTagVersion)]
-        assert len(tag) == 1, "no tag target set"
-        return tag[0]
+        tag = self.find_tag_target()
+        assert tag is not None, "no tag target set"
+        return tag
 
-    def is_clean(self):
+    def is_clean(self, status=None):
+        if status is not None:
+            return status.is_clean(self)
         if self.filenames:
             return test('git diff --exit-code ' + ' '.join(self.filenames))
         else:
             return test('git diff --exit-code {path}'.format(**self.__dict__))
 
-    def count_untracked_files(self):
+    def count_untracked_files(self, status=None):
+        if status is not None:
+            return len(status.untracked_files(self))
         cmd = 'git ls-files --other --exclude-standard --directory {path}'.format(
             path=self.path)
         result = os.popen(cmd).read()
         # count non empty lines
         return len([k for k in result.split('\n') if k.strip()])
 
-    def diff(self):
-        tag = self.get_tag_target()
-        if tag.exists():
-            clean = tag.diff(path=self.path)
-        else:
-            print("No tag exists")
+    @property
+    def context(self):
+        return command_context(package=self.name)
 
-    def print_status(self):
-        clean = self.is_clean()
-        status = ''
-        if clean:
-            status += '\t' + green('clean                 ')
-        else:
-            status += '\t' + red('dirty (commit changes)')
+    def diff(self, repo_status=None):
+        with self.context:
+            self._diff(repo_status)
+
+    def _diff(self, repo_status=None):
         tag = self.get_tag_target()
-        if tag.exists():
-            clean = tag.clean_since(path=self.path)
-            if clean:
-                status += '|' + green('everything up to date           ')
+        if repo_status.tag_exists(self) if repo_status is not None else tag.exists():
+            if repo_status is not None and not repo_status.changed_since_tag(self):
+                print("No changes since {}".format(tag))
             else:
-                status += '|' + red('version bump needed & release   ')
+                tag.diff(path=self.path)
         else:
-            status += '|' + red('version not tagged, run release?')
-        untracked = self.count_untracked_files()
-        if untracked:
-            status += '|' + red('%d untracked files' % untracked)
-        print('{name}:\t{status}'.format(status=status, **self.__dict__))
+            print("No tag exists")
+
+    def print_status(self, repo_status=None):
+        with self.context:
+            self._print_status(repo_status)
+
+    def state(self, repo_status=None):
+        """Returns the status of the package as a (json serializable) dict"""
+        repo_status = repo_status or RepoStatus([self])
+        changed = repo_status.changed_since_tag(self)
+        return dict(clean=repo_status.is_clean(self), tag_exists=changed is not None,
+                    changed=bool(changed), untracked=repo_status.untracked_files(self),
+                    uploaded=repo_status.published.get(self.name))
+
+    def _print_status(self, repo_status=None):
+        state = self.state(repo_status)
+        print(format_status(self.name, state))
         if verbose:
             print('Untracked files:')
-            cmd = 'git ls-files --other --exclude-standard --directory {path}'.format(
-                path=self.path)
-            execute_always(cmd)
+            for filename in state['untracked']:
+                print(filename)
 
-    def bump(self, what):
+    def bump(self, what, repo_status=None):
         # this is git specific, move this out
-        if not self.is_clean():
+        if not self.is_clean(repo_status):
             msg = 'package {name} (dir: {path}) dirty, commit changes first'.format(
                 **self.__dict__)
             if force:
@@ -708,29 +2219,710 @@ class Package:
                 error(msg)
         self.version_source.bump(what)
 
-    def set(self):
+    def stage(self, *filenames):
+        """Marks files as changed, to be committed by commit()"""
+        self.changed_files += [k for k in filenames if k not in self.changed_files]
+
+    def save(self):
+        """Writes the version to all version targets, part of the current write session if there is one"""
         for target in self.version_targets:
             target.version_source = self.version_source
         for target in self.version_targets:
-            target.save()
-        execute('git commit -m "🔖 {name} {version} released"'.format(
-            version=self.version_source, name=self.name))
+            with command_context(package=self.name, target=type(target).__name__):
+                target.save()
+
+    def commit(self):
+        with command_context(package=self.name, target='commit', serial=True):
+            git_commit('🔖 {name} {version} released'.format(
+                version=self.version_source, name=self.name), self.changed_files)
+        self.changed_files = []
+
+    def set(self):
+        with write_session():
+            self.save()
+        self.commit()
 
     def tag(self, last):
         for tag_target in self.tag_targets:
-            tag_target.do(last_package=last)
+            with command_context(package=self.name, target=type(tag_target).__name__, serial=True):
+                tag_target.do(last_package=last)
+
+
+def format_status(name, state):
+    status = ''
+    if state['clean']:
+        status += '\t' + green('clean                 ')
+    else:
+        status += '\t' + red('dirty (commit changes)')
+    if state['tag_exists']:
+        if not state['changed']:
+            status += '|' + green('everything up to date           ')
+        else:
+            status += '|' + red('version bump needed & release   ')
+    else:
+        status += '|' + red('version not tagged, run release?')
+    if state['tag_exists'] and state.get('uploaded') is False:
+        status += '|' + red('tagged but not uploaded')
+    if state['untracked']:
+        status += '|' + red('%d untracked files' % len(state['untracked']))
+    return '{name}:\t{status}'.format(name=name, status=status)
 
 
-def add_package(path, name=None, package_name=None, distribution_name=None, version_source=None, filenames=None):
+def add_package(path, name=None, package_name=None, distribution_name=None, version_source=None, filenames=None, dependencies=None):
     name = name or os.path.split(path)[-1]
     package_name = package_name or name
-    package = Package(path, name, distribution_name=distribution_name, package_name=package_name, version_source=version_source, filenames=filenames)
+    package = Package(path, name, distribution_name=distribution_name, package_name=package_name, version_source=version_source, filenames=filenames,
+                      dependencies=dependencies)
     packages.append(package)
     package_names.append(name)
     package_map[name] = package
     return package
 
 
+def _requirement_name(requirement):
+    match = re.match(r'\s*([A-Za-z0-9][A-Za-z0-9._-]*)', requirement)
+    return _normalize_name(match.group(1)) if match else None
+
+
+def _normalize_name(name):
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def setup_py_requirements(filename):
+    """Returns the install_requires of a setup.py, without running it (only literal lists are found)"""
+    import ast
+    with open(filename) as f:
+        tree = ast.parse(f.read(), filename)
+    requirements = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.keyword) and node.arg == 'install_requires':
+            if isinstance(node.value, (ast.List, ast.Tuple)):
+                for element in node.value.elts:
+                    try:  # not ast.Constant, before python 3.8 strings are ast.Str
+                        value = ast.literal_eval(element)
+                    except ValueError:
+                        continue
+                    if isinstance(value, str):
+                        requirements.append(value)
+    return requirements
+
+
+class Scheduler(object):
+    """Runs a function for each package, but only after the packages it depends on are done.
+
+    Packages are ordered topologically (keeping the given order where possible), and with
+    jobs > 1 independent packages run in parallel. The time of each package is recorded, to
+    find the critical path: the chain of dependencies that bounds the total time.
+    """
+
+    def __init__(self, packages):
+        self.packages = list(packages)
+        names = set(k.name for k in self.packages)
+        # only dependencies we are working on matter
+        self.dependencies = {package.name: [k for k in package.get_dependencies() if k in names]
+                             for package in self.packages}
+        self.order = self._topological_order()
+        self.durations = {}
+
+    def _topological_order(self):
+        order = []
+        done = set()
+        todo = list(self.packages)
+        while todo:
+            ready = [k for k in todo if all(dep in done for dep in self.dependencies[k.name])]
+            if not ready:
+                error('circular dependency between packages: {}', ', '.join(k.name for k in todo))
+            # take the first one, to keep the original order where possible
+            order.append(ready[0])
+            done.add(ready[0].name)
+            todo.remove(ready[0])
+        return order
+
+    @property
+    def last(self):
+        return self.order[-1] if self.order else None
+
+    def _timed(self, func):
+        def wrapper(package):
+            start = time.time()
+            try:
+                return func(package)
+            finally:
+                self.durations[package.name] = time.time() - start
+        return wrapper
+
+    def run(self, func):
+        func = self._timed(func)
+        if jobs <= 1 or interactive or len(self.order) <= 1:
+            for package in self.order:
+                func(package)
+            return
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        finished = set()
+        outputs = {}
+        running = {}
+        printed = 0
+        with _thread_stdout() as stdout:
+            executor = ThreadPoolExecutor(max_workers=jobs)
+            try:
+                while printed < len(self.order):
+                    for package in self.order:
+                        if package.name not in finished and package not in running.values() and \
+                           all(dep in finished for dep in self.dependencies[package.name]):
+                            running[executor.submit(_buffered, func, package)] = package
+                    done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                    failure = None
+                    for future in done:
+                        package = running.pop(future)
+                        _, exception, outputs[package.name] = future.result()
+                        finished.add(package.name)
+                        failure = failure or exception
+                    # print in topological order, as soon as possible
+                    while printed < len(self.order) and self.order[printed].name in outputs:
+                        stdout.write(outputs[self.order[printed].name])
+                        printed += 1
+                    stdout.flush()
+                    if failure is not None:
+                        for future in running:
+                            stdout.write(future.result()[2])
+                        raise failure
+            finally:
+                executor.shutdown(wait=True)
+
+    def critical_path(self):
+        """Returns the chain of packages with the largest total duration, and that duration"""
+        best = {}  # name -> (duration, path)
+        for package in self.order:
+            duration = self.durations.get(package.name, 0)
+            previous = max([best[dep] for dep in self.dependencies[package.name]] or [(0, [])],
+                           key=lambda k: k[0])
+            best[package.name] = (previous[0] + duration, previous[1] + [package])
+        if not best:
+            return [], 0
+        total, path = max(best.values(), key=lambda k: k[0])
+        return path, total
+
+    def print_critical_path(self):
+        path, total = self.critical_path()
+        info('critical path: {} ({:.1f}s)', ' -> '.join(k.name for k in path), total)
+
+
+class Step(object):
+    """A single step of a Plan: a command, or a python function (run) for edits, tags and targets"""
+
+    def __init__(self, description, kind='command', cmd=None, run=None, package=None, target=None,
+                 serial=False, files=None, confirm=False):
+        self.description = description
+        self.confirm = confirm  # ask before running it in interactive mode (commands always ask, see execute)
+        self.kind = kind
+        self.cmd = cmd
+        self.run = run
+        self.package = package
+        self.target = target
+        self.serial = serial
+        self.files = files or []
+        self.deps = []
+        self.version = None
+
+    @property
+    def key(self):
+        """Steps with the same key do the same thing, and are only done once"""
+        return (self.kind, self.cmd or self.description)
+
+    @property
+    def estimate_keys(self):
+        """Keys to look up the duration of this step in the timing history, most specific first"""
+        kind = _command_kind(self.cmd) if self.cmd else (self.target or self.kind)
+        return (['{}:{}'.format(self.package, kind)] if self.package else []) + [kind]
+
+    def execute(self):
+        """Runs the step, returns False when the user declined (part of) it in interactive mode"""
+        declined = getattr(_thread_state, 'declined', 0)
+        with command_context(package=self.package, target=self.target):
+            if self.run is not None:
+                if self.confirm and interactive and not confirm(self.description, 'Run'):
+                    return False
+                self.run()
+            else:
+                execute(self.cmd)
+        return getattr(_thread_state, 'declined', 0) == declined
+
+    def to_dict(self, index, estimate):
+        return dict(index=index, kind=self.kind, description=self.description, package=self.package,
+                    target=self.target, serial=self.serial, files=self.files, deps=self.deps,
+                    estimate=estimate)
+
+
+class Plan(object):
+    """Everything bump, set or release will do, compiled before anything is done.
+
+    While compiling (see compile_plan), execute() and the write session, tag batch and
+    non plannable release targets add steps instead of doing something. Identical steps
+    are only added once. The plan can then be shown (--dry-run, --plan-json) with estimated
+    durations from earlier runs (.git/releash-timings.json), or executed.
+    """
+    history_filename = 'releash-timings.json'
+
+    def __init__(self):
+        self.steps = []
+        self.keys = set()
+        self.git_dir = find_git_dir()
+        self.history = _read_json(os.path.join(self.git_dir, self.history_filename), {}) if self.git_dir else {}
+
+    def add_command(self, cmd):
+        context = getattr(_thread_state, 'context', {})
+        self.add(Step(cmd, cmd=cmd, serial=context.get('serial', False)))
+
+    def add(self, step):
+        context = getattr(_thread_state, 'context', {})
+        step.package = step.package or context.get('package')
+        step.target = step.target or context.get('target')
+        if step.package in package_map:
+            step.version = str(package_map[step.package].version_source)
+        if step.key in self.keys:
+            debug('step already planned: {}', step.description)
+            return
+        self.keys.add(step.key)
+        # a step depends on the previous step of the same package, and serial steps on each other
+        for previous in reversed(range(len(self.steps))):
+            if self.steps[previous].package == step.package and step.package is not None:
+                step.deps.append(previous)
+                break
+        if step.serial:
+            for previous in reversed(range(len(self.steps))):
+                if self.steps[previous].serial:
+                    if previous not in step.deps:
+                        step.deps.append(previous)
+                    break
+        self.steps.append(step)
+
+    def estimate(self, step):
+        for key in step.estimate_keys:
+            if key in self.history:
+                return self.history[key]
+
+    def print(self):
+        estimates = [self.estimate(step) for step in self.steps]
+        total = sum(k for step, k in zip(self.steps, estimates) if k is not None and step.serial)
+        per_package = collections.defaultdict(float)
+        for step, estimate in zip(self.steps, estimates):
+            if estimate is not None and not step.serial:
+                per_package[step.package] += estimate
+        # with jobs > 1 the packages are done in parallel, so the slowest package dominates
+        total += (max(per_package.values()) if jobs > 1 else sum(per_package.values())) if per_package else 0
+        unknown = len([k for k in estimates if k is None])
+        print('plan: {} steps, estimated {:.1f}s{}'.format(
+              len(self.steps), total, ' (+ {} steps without timing history)'.format(unknown) if unknown else ''))
+        for index, (step, estimate) in enumerate(zip(self.steps, estimates)):
+            print('{:4}. {:>8} [{}/{}]{} {}'.format(
+                  index + 1, '~%.1fs' % estimate if estimate is not None else '?',
+                  step.package or '-', step.target or step.kind, ' (serial)' if step.serial else '',
+                  step.description))
+            if verbose and step.kind == 'edit':
+                for filename, content in step.run.__self__.apply():
+                    print("would write to {}:\n{}".format(filename, content))
+
+    def write_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump([step.to_dict(index, self.estimate(step)) for index, step in enumerate(self.steps)], f, indent=2)
+
+    def run(self, scheduler=None, journal=None, resume=False):
+        """Runs all steps, with jobs > 1 the non serial steps in parallel per package first
+
+        Finished steps are recorded in the journal (not the ones the user declined), with resume,
+        steps found in the journal are skipped.
+        """
+        timings = []
+
+        def run_step(step):
+            if resume and journal is not None and journal.done(step):
+                info('skipping (already done): {}', step.description)
+                return
+            start = time.time()
+            if not step.execute():
+                info('not done: {}', step.description)  # so not recorded in the journal or timings
+                return
+            duration = time.time() - start
+            timings.append((step, duration))
+            if scheduler is not None and step.package is not None:
+                # per package durations, for the critical path (in parallel, Scheduler.run measures them)
+                scheduler.durations[step.package] = scheduler.durations.get(step.package, 0) + duration
+            if journal is not None:
+                journal.record(step)
+
+        try:
+            if jobs > 1 and scheduler is not None:
+                scheduler.run(lambda package: [run_step(step) for step in self.steps
+                                               if not step.serial and step.package == package.name])
+                parallel = set(package.name for package in scheduler.order)
+                for step in self.steps:
+                    if step.serial or step.package not in parallel:
+                        run_step(step)
+            else:
+                for step in self.steps:
+                    run_step(step)
+        finally:
+            self.save_history(timings)
+
+    def save_history(self, timings, weight=0.3):
+        if self.git_dir is None or dry_run or not timings:
+            return
+        for step, duration in timings:
+            for key in step.estimate_keys:
+                previous = self.history.get(key)
+                # exponential moving average, so the estimate follows changes
+                self.history[key] = duration if previous is None else previous * (1 - weight) + duration * weight
+        _write_json(os.path.join(self.git_dir, self.history_filename), self.history)
+
+
+class Journal(object):
+    """Append only record of finished steps in .git/releash-journal.jsonl
+
+    Each line is a json object with the package, version and step (kind and command or description),
+    so a failed release can be resumed (release --resume) without redoing what already succeeded.
+    A new version of a package gives new entries, so the journal never needs to be cleared.
+    """
+    filename = 'releash-journal.jsonl'
+
+    def __init__(self, git_dir):
+        self.path = os.path.join(git_dir, self.filename)
+        self.lock = threading.Lock()
+        self.finished = set()
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:  # a line can be incomplete if we were killed while writing
+                        continue
+                    self.finished.add(self._key(entry['package'], entry['version'], entry['step']))
+
+    @staticmethod
+    def _key(package, version, step):
+        return (package, version, tuple(step))
+
+    def done(self, step):
+        return self._key(step.package, step.version, step.key) in self.finished
+
+    def record(self, step):
+        if dry_run:
+            return
+        entry = dict(package=step.package, version=step.version, step=list(step.key), time=time.time())
+        with self.lock:
+            self.finished.add(self._key(step.package, step.version, step.key))
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+
+_plan = None
+
+
+def compile_plan(func):
+    """Calls func, recording what it would do in a Plan, instead of doing it"""
+    global _plan, dry_run
+    plan = Plan()
+    _plan = plan
+    was_dry_run, dry_run = dry_run, False  # targets should plan what they would really do
+    try:
+        func()
+    finally:
+        _plan = None
+        dry_run = was_dry_run
+    return plan
+
+
+def run_plan(plan, args, scheduler=None):
+    if args.plan_json:
+        plan.write_json(args.plan_json)
+    resume = getattr(args, 'resume', False)
+    journal = Journal(plan.git_dir) if plan.git_dir else None
+    if resume and journal is None:
+        error('cannot resume, no git repo found')
+    if dry_run:
+        if resume:
+            plan.steps = [step for step in plan.steps if not journal.done(step)]
+        plan.print()
+    else:
+        plan.run(scheduler, journal, resume)
+
+
+def _strip_to_null(cmd):
+    return cmd.replace(_to_null, '').strip()
+
+
+def _command_kind(cmd):
+    """Groups commands, e.g. 'cd foo && python setup.py sdist' -> 'python setup.py'"""
+    cmd = _strip_to_null(cmd).split('&&')[-1].split()
+    return ' '.join(cmd[:3] if cmd[:1] == ['python'] else cmd[:2])
+
+
+def print_profile(trace_filename=None):
+    """Prints how much time was spent in which (kind of) commands, optionally writes a Chrome trace file"""
+    kinds = {}
+    for record in command_log:
+        kind = kinds.setdefault(_command_kind(record['cmd']), [0, 0., 0.])
+        kind[0] += 1
+        kind[1] += record['duration']
+        kind[2] = max(kind[2], record['duration'])
+    print('profile ({} commands):'.format(len(command_log)))
+    print('\t{:>8} {:>6} {:>8}  {}'.format('total', 'count', 'max', 'command'))
+    for name, (count, total, longest) in sorted(kinds.items(), key=lambda k: -k[1][1]):
+        print('\t{:>7.2f}s {:>6} {:>7.2f}s  {}'.format(total, count, longest, name))
+    print('slowest commands:')
+    for record in sorted(command_log, key=lambda k: -k['duration'])[:10]:
+        print('\t{:>7.2f}s  [{}/{}] exit code {}: {}'.format(
+              record['duration'], record.get('package', '-'), record.get('target', '-'),
+              record['exit_code'], _strip_to_null(record['cmd'])))
+    if trace_filename:
+        threads = []
+        events = []
+        for record in command_log:
+            if record['thread'] not in threads:
+                threads.append(record['thread'])
+            events.append(dict(name=_strip_to_null(record['cmd']), ph='X', pid=1,
+                               cat=record.get('target', 'releash'),
+                               tid=threads.index(record['thread']),
+                               ts=int(record['start'] * 1e6), dur=int(record['duration'] * 1e6),
+                               args=dict(package=record.get('package'), exit_code=record['exit_code'])))
+        with open(trace_filename, 'w') as f:
+            json.dump(dict(traceEvents=events), f)
+        info('wrote trace to {} (open it in chrome://tracing or https://ui.perfetto.dev)', trace_filename)
+
+
+class InotifyWatcher(object):
+    """Watches directories (recursively) for changes using Linux' inotify, through ctypes"""
+    IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+    IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+    IN_Q_OVERFLOW, IN_ISDIR = 0x4000, 0x40000000
+    mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        self.directories = {}  # watch descriptor -> directory
+
+    def add(self, path, skip=('.git',)):
+        import ctypes
+        for directory, names, filenames in os.walk(path):
+            names[:] = [k for k in names if k not in skip]
+            wd = self.libc.inotify_add_watch(self.fd, directory.encode(sys.getfilesystemencoding()), self.mask)
+            if wd < 0:  # e.g. ENOSPC when we run out of watches
+                raise OSError(ctypes.get_errno(), 'could not watch ' + directory)
+            self.directories[wd] = directory
+
+    def read(self, timeout):
+        """Waits for changes, returns the changed paths, or None when we lost track"""
+        import select
+        import struct
+        paths = []
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        while readable:
+            data = os.read(self.fd, 64 * 1024)
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+                name = data[offset + 16:offset + 16 + length].rstrip(b'\0').decode(sys.getfilesystemencoding())
+                offset += 16 + length
+                if mask & self.IN_Q_OVERFLOW:
+                    return None
+                if wd in self.directories:
+                    path = os.path.join(self.directories[wd], name)
+                    paths.append(path)
+                    if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                        self.add(path)
+            # changes come in bursts (e.g. git checkout), collect them all
+            readable, _, _ = select.select([self.fd], [], [], 0.05)
+        return paths
+
+
+class PollingWatcher(object):
+    """Fallback when inotify is not available: reports that everything may have changed every interval"""
+
+    def __init__(self, interval):
+        self.interval = interval
+
+    def add(self, path):
+        pass
+
+    def read(self, timeout):
+        time.sleep(self.interval)
+        return None
+
+
+class StatusServer(object):
+    """Keeps the status of all packages up to date, and answers queries over a Unix socket.
+
+    The packages are loaded once. A watcher reports changed paths: changes in the working tree
+    only update the packages owning those paths (found with the PathTrie of RepoStatus),
+    changes to HEAD, the index or refs update all packages. The tag state comes from the
+    StatusCache, so this rarely needs git. The protocol is one line per request, answered
+    with one line of json:
+        status [package ...]  -> {name: state} (see Package.state)
+        refresh               -> recomputes everything
+    """
+
+    def __init__(self, socket_path, poll_interval=None):
+        self.socket_path = socket_path
+        self.git_dir = find_git_dir()
+        if self.git_dir is None:
+            error('not in a git repository')
+        self.state = {}
+        self.lock = threading.Lock()
+        self.watcher = None
+        if poll_interval is None:
+            try:
+                self.watcher = InotifyWatcher()
+            except (OSError, AttributeError, TypeError) as e:
+                info('inotify not available ({}), will poll', e)
+        self.poll_interval = poll_interval or 2
+        self.refresh()
+
+    def refresh(self, names=None):
+        """Recomputes the state of the named packages (or all, after HEAD, the index or refs changed)"""
+        global _tag_index
+        if names is None:
+            with _tag_index_lock:
+                _tag_index = None  # tags may have been added or removed
+        for package in packages:
+            if names is None or package.name in names:
+                self.reload_version(package)
+        cache = StatusCache(self.git_dir)
+        repo_status = RepoStatus(cache=cache)
+        state = {package.name: package.state(repo_status) for package in packages
+                 if names is None or package.name in names}
+        cache.save()
+        with self.lock:
+            self.state.update(state)
+            self.repo_status = repo_status
+        debug('refreshed {}', ', '.join(sorted(state)))
+
+    def reload_version(self, package):
+        """Reads the version again, it may have been changed (e.g. by releash bump)"""
+        find_version = getattr(package.version_source, 'find_version', None)
+        if find_version is None:
+            return
+        try:
+            find_version()
+        except (SystemExit, Exception) as e:  # the file may be half written, keep the old version
+            debug('could not read the version of {}: {}', package.name, e)
+
+    def affected(self, paths):
+        """Returns the names of the packages affected by the changed paths, or None for all"""
+        names = set()
+        for path in paths:
+            relative = os.path.relpath(path, self.git_dir)
+            if not relative.startswith(os.pardir):
+                parts = relative.split(os.sep)
+                if parts[0] in ('HEAD', 'index', 'packed-refs', 'refs') and not path.endswith('.lock'):
+                    return None
+                continue
+            path = self.repo_status.repo_path(path)
+            for trie in [self.repo_status.path_trie, self.repo_status.dirty_trie]:
+                names.update(trie.owners(path) + trie.within(path))
+        return names
+
+    def watch(self):
+        if self.watcher is not None:
+            try:
+                for package in packages:
+                    self.watcher.add(package.path)
+                self.watcher.add(self.git_dir, skip=('objects', 'logs', 'hooks', 'info'))
+            except OSError as e:
+                info('could not watch all directories ({}), will poll', e)
+                self.watcher = None
+        watcher = self.watcher or PollingWatcher(self.poll_interval)
+        while True:
+            paths = watcher.read(timeout=self.poll_interval * 10)
+            if paths == []:
+                continue
+            names = self.affected(paths) if paths is not None else None
+            if names is None or names:
+                self.refresh(names)
+
+    def query(self, line):
+        words = line.split()
+        if not words:
+            return {}
+        if words[0] == 'status':
+            with self.lock:
+                return {name: state for name, state in self.state.items() if len(words) == 1 or name in words[1:]}
+        elif words[0] == 'refresh':
+            self.refresh()
+            return {'ok': True}
+        return {'error': 'unknown command: ' + words[0]}
+
+    def serve(self):
+        import socketserver
+        server_ = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    reply = server_.query(line.decode('utf8'))
+                    self.wfile.write((json.dumps(reply) + '\n').encode('utf8'))
+                    self.wfile.flush()
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        info('serving status of {} packages on {}', len(packages), self.socket_path)
+        import signal
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # clean up on kill as well
+        try:
+            self.watch()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.shutdown()
+            server.server_close()
+            os.remove(self.socket_path)
+
+
+def query_server(socket_path, request):
+    """Sends a request to a running releash serve, and returns the reply"""
+    import socket
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        client.sendall((request + '\n').encode('utf8'))
+        reply = client.makefile('rb').readline()
+    finally:
+        client.close()
+    return json.loads(reply.decode('utf8'))
+
+
+def default_socket_path():
+    return os.path.join(find_git_dir() or '.', 'releash.sock')
+
+
+def status_cache(args):
+    git_dir = find_git_dir()
+    if args.no_cache or git_dir is None:
+        return None
+    return StatusCache(git_dir)
+
+
+def cmd_changed(args):
+    """Prints the packages that changed since their last tag (or were never tagged)"""
+    selected = [package for package, last in package_iter(args.packages or package_names)]
+    repo_status = RepoStatus(cache=status_cache(args))
+    for package in selected:
+        if repo_status.changed_since_tag(package) is not False:
+            print(package.name)
+    if repo_status.cache:
+        repo_status.cache.save()
+
+
 def cmd_list(args):
     print("packages:")
     for package in packages:
@@ -749,7 +2941,7 @@ def package_iter(package_names):
 
 def main(argv=sys.argv):
     import argparse
-    global dry_run, force, verbose, quiet, interactive
+    global dry_run, force, verbose, quiet, interactive, jobs
     parser = argparse.ArgumentParser(argv[0])
 
     subparsers = parser.add_subparsers(help='type of command', dest="task")
@@ -757,6 +2949,8 @@ def main(argv=sys.argv):
     parser_status  = subparsers.add_parser('status', help='list packages\' status')
     parser_diff    = subparsers.add_parser('diff', help='Show diff since last release')
     parser_list    = subparsers.add_parser('list', help='list packages')
+    parser_changed = subparsers.add_parser('changed', help='list packages changed since their last release')
+    parser_serve   = subparsers.add_parser('serve', help='keep the status up to date, and serve it on a unix socket')
     parser_set     = subparsers.add_parser('set', help='set versions')
     parser_bump    = subparsers.add_parser('bump', help='bump version nr')
     parser_release = subparsers.add_parser('release', help='release software')
@@ -764,6 +2958,17 @@ def main(argv=sys.argv):
 
     parser_status.add_argument('packages', help="which packages", nargs="*")
     parser_diff.add_argument('packages', help="which packages", nargs="*")
+    parser_changed.add_argument('packages', help="which packages", nargs="*")
+    for subparser in [parser_status, parser_serve]:
+        subparser.add_argument('--socket', default=None,
+                               help="unix socket of releash serve (default: .git/releash.sock for serve)")
+    parser_serve.add_argument('--poll', type=float, default=None, metavar='SECONDS',
+                              help="poll every SECONDS instead of watching files with inotify")
+    for subparser in [parser_status, parser_changed]:
+        subparser.add_argument('--no-cache', action='store_true', default=False,
+                               help="do not use the tag state cached in .git/releash-status.json")
+    parser_status.add_argument('--check-index', action='store_true', default=False,
+                               help="ask the package index if tagged versions are uploaded (otherwise only uploads found earlier are shown)")
 
     action_subparsers = [parser_bump, parser_release, parser_diff,
                          parser_set, parser_conda_forge_init]
@@ -774,15 +2979,32 @@ def main(argv=sys.argv):
                                default=False, help="force actions (such as tagging)")
         subparser.add_argument('--interactive', '-i', action='store_true',
                                default=False, help="ask for confirmation before running")
-    for subparser in action_subparsers + [parser_status, parser, parser_list]:
+    for subparser in action_subparsers + [parser_status, parser, parser_list, parser_changed, parser_serve]:
         subparser.add_argument('--verbose', '-v', action='store_true', default=False, help="more output")
         subparser.add_argument('--quiet', '-q', action='store_true', default=False, help="less output")
+        subparser.add_argument('--profile', action='store_true', default=False,
+                               help="print how much time was spent in which commands")
+        subparser.add_argument('--profile-trace', default=None, metavar='FILENAME',
+                               help="write a Chrome trace event file of all commands (implies --profile)")
+
+    for subparser in [parser_status, parser_diff, parser_bump, parser_set, parser_release]:
+        subparser.add_argument('--jobs', '-j', type=int, default=1,
+                               help="number of packages to process in parallel (git commits, tags and pushes stay serial)")
+
+    for subparser in [parser_bump, parser_set, parser_release]:
+        subparser.add_argument('--plan-json', default=None, metavar='FILENAME',
+                               help="write the plan (what will be done, in which order) as json")
+    for subparser in [parser_bump, parser_set]:
+        subparser.add_argument('--single-commit', action='store_true', default=False,
+                               help="commit the new versions of all packages in a single commit")
 
     parser_bump.add_argument('--all', '-a', action='store_true', default=False, help="all packages")
     parser_bump.add_argument('packages', help="which packages", nargs="*")
     parser_bump.add_argument('--what', '-w', help="'major', 'minor', 'patch', 'prerelease', 'build', 'last' or 'finalize'", default='last')
 
     parser_release.add_argument('packages', help="which packages", nargs="*")
+    parser_release.add_argument('--resume', action='store_true', default=False,
+                                help="skip the steps that were done by an earlier (failed) release of the same versions")
 
     parser_set.add_argument('packages', help="which packages", nargs="*")
 
@@ -791,7 +3013,8 @@ def main(argv=sys.argv):
 
     args = parser.parse_args(argv[1:])
 
-    imp.load_source('releash-config', '.releash.py')
+    import runpy
+    runpy.run_path('.releash.py', run_name='releash-config')
 
     if hasattr(args, 'dry_run'):
         dry_run = args.dry_run
@@ -799,28 +3022,85 @@ def main(argv=sys.argv):
         force = args.force
     if hasattr(args, 'interactive'):
         interactive = args.interactive
+    if hasattr(args, 'jobs'):
+        jobs = args.jobs
     verbose = args.verbose
     quiet = args.quiet
+    try:
+        run_task(args)
+    finally:
+        if args.profile or args.profile_trace:
+            print_profile(args.profile_trace)
+
+
+def set_and_tag(args):
+    # first write all files, so an error leaves no package half written
+    with write_session():
+        for package, last in package_iter(args.packages or package_names):
+            package.save()
+    with tag_batch():
+        if args.single_commit:
+            # tags can only be made after the commit
+            with single_commit():
+                for package, last in package_iter(args.packages or package_names):
+                    package.commit()
+            for package, last in package_iter(args.packages or package_names):
+                package.tag(last)
+        else:
+            for package, last in package_iter(args.packages or package_names):
+                package.commit()
+                package.tag(last)
+
+
+def run_task(args):
     if args.task == "list":
         cmd_list(args)
+    elif args.task == "status" and args.socket:
+        selected = [package.name for package, last in package_iter(args.packages or package_names)]
+        state = query_server(args.socket, 'status ' + ' '.join(selected))
+        for name in selected:
+            print(format_status(name, state[name]))
+    elif args.task == "serve":
+        StatusServer(args.socket or default_socket_path(), args.poll).serve()
     elif args.task == "status":
-        for package, last in package_iter(args.packages or package_names):
-            package.print_status()
+        repo_status = RepoStatus(cache=status_cache(args))
+        selected = [package for package, last in package_iter(args.packages or package_names)]
+        # only tagged versions are reported, and by default only what earlier lookups found is used
+        tagged = [package for package in selected if repo_status.changed_since_tag(package) is not None]
+        repo_status.published = published(tagged, offline=not args.check_index)
+        for_each(lambda item: item[0].print_status(repo_status),
+                 package_iter(args.packages or package_names))
+        if repo_status.cache:
+            repo_status.cache.save()
     elif args.task == "diff":
-        for package, last in package_iter(args.packages or package_names):
-            package.diff()
+        repo_status = RepoStatus()
+        for_each(lambda item: item[0].diff(repo_status),
+                 package_iter(args.packages or package_names))
+    elif args.task == "changed":
+        cmd_changed(args)
     elif args.task == "bump":
-        for package, last in package_iter(args.packages or package_names):
-            package.bump(args.what)
-            package.set()
-            package.tag(last)
+        repo_status = RepoStatus()
+        # bumping is independent per package, committing and tagging is not
+        for_each(lambda item: item[0].bump(args.what, repo_status),
+                 package_iter(args.packages or package_names))
+        run_plan(compile_plan(lambda: set_and_tag(args)), args)
     elif args.task == "set":
-        for package, last in package_iter(args.packages or package_names):
-            package.set()
-            package.tag(last)
+        run_plan(compile_plan(lambda: set_and_tag(args)), args)
     elif args.task == "release":
-        for package, last in package_iter(args.packages or package_names):
-            package.release(last)
+        # packages are released after the packages they depend on
+        scheduler = Scheduler(package for package, last in package_iter(args.packages or package_names))
+
+        # what is already uploaded is skipped, look that up for all packages at once
+        lookup_published_files(scheduler.order)
+
+        def release():
+            with tag_batch():
+                for package in scheduler.order:
+                    package.release(package is scheduler.last)
+        # with jobs > 1, first the independent work (building, uploading), then tagging and pushing in order
+        run_plan(compile_plan(release), args, scheduler)
+        if len(scheduler.order) > 1 and scheduler.durations and not quiet and not dry_run:
+            scheduler.print_critical_path()
     elif args.task == "conda-forge-init":
         if args.repo is None:
             error("please provide --repo")
@@ -835,14 +3115,13 @@ def main(argv=sys.argv):
 
             version_unnormalized = str(package.version_source)
             # this is what setuptools does
-            version_normalized = pkg_resources.safe_version(
+            version_normalized = safe_version(
                 version_unnormalized)
 
             source_tarball_filename = os.path.join(
                 package.path, 'dist', package.name + '-' + version_normalized + '.tar.gz')
             expect_file(source_tarball_filename)
-            with open(source_tarball_filename, 'rb') as f:
-                hash_sha256 = hashlib.sha256(f.read()).hexdigest()
+            hash_sha256 = hash_file(source_tarball_filename)['sha256']
             print("for", package.name)
             format_kwargs = dict(repo_path=args.repo, name=package.name, version=version_normalized,
                                  path=package.path,
@@ -855,25 +3134,14 @@ def main(argv=sys.argv):
             execute(cmd)
             # cmd = "cd {repo_path}/recipes && conda skeleton pypi {name} --version={version}".format(**format_kwargs)
             # execute(cmd)
-            cmd = "cd {repo_path}/recipes && mkdir -p {name}".format(
-                **format_kwargs)
-            execute(cmd)
-
-            cmd = "cd {path} && python setup.py egg_info".format(
-                **format_kwargs)
-            execute(cmd)
-            print(format_kwargs)
-            with open('{path}/{nameu}.egg-info/requires.txt'.format(**format_kwargs)) as f:
-                requires = [k.strip() for k in f.readlines()]
+            recipe_path = os.path.join(args.repo, 'recipes', package.name)
+            if not dry_run and not os.path.exists(recipe_path):
+                os.makedirs(recipe_path)
 
             format_kwargs_feedstock = dict(format_kwargs)
-            with open('{path}/{nameu}.egg-info/PKG-INFO'.format(**format_kwargs)) as f:
-                for line in f.readlines():
-                    line = line.strip()
-                    if line:
-                        key, value = line.split(":", 1)
-                        format_kwargs_feedstock[key.strip()] = value.strip()
-            # print(, end='')
+            metadata = recipe_metadata(source_tarball_filename, package.path)
+            requires = metadata.pop('requires')
+            format_kwargs_feedstock.update(metadata)
 
             format_kwargs_feedstock['maintainer'] = ask(
                 'What is your github username (for maintainer entry)? ', os.environ['USER'])
@@ -895,7 +3163,7 @@ source:
 build:
   number: 0
   noarch: python''')
-                if os.path.exists('{path}/{nameu}.egg-info/entry_points.txt'.format(**format_kwargs)):
+                if metadata['entry_points']:
                     print_file(f, '  preserve_egg_dir: True')
                 print_file(f, '''  script: python setup.py install --single-version-externally-managed --record record.txt
 
@@ -15,7 +15,7 @@ setup(
     url='https://github.com/maartenbreddels/releash',
     author='Maarten A. Breddels',
     author_email='maartenbreddels@gmail.com',
-    install_requires=['semver'],
+    install_requires=['semver', 'packaging'],
     license='MIT',
     py_modules=['releash'],
     entry_points = {
@@ -0,0 +1,43 @@
+import threading
+
+import pytest
+
+try:
+    from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # py2
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+
+import releash
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def serve():
+    """Starts a local http server with the given handler class, and returns its url"""
+    servers = []
+
+    def start(handler_class):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        servers.append(server)
+        return 'http://127.0.0.1:{}'.format(server.server_address[1])
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def releash_state(monkeypatch, tmp_path):
+    """Gives each test its own cache directory, and resets the global state of releash"""
+    monkeypatch.setenv('RELEASH_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(releash, 'quiet', True)
+    monkeypatch.setattr(releash, '_cache_in_use', set())
+    monkeypatch.setattr(releash, '_hash_cache', {})
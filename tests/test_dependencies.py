@@ -0,0 +1,18 @@
+import releash
+
+
+def test_setup_py_requirements(tmp_path):
+    filename = str(tmp_path / 'setup.py')
+    with open(filename, 'w') as f:
+        f.write("from setuptools import setup\n"
+                "extra = 'c'\n"
+                "setup(name='b', install_requires=['a>=1.0', \"six\", extra])\n")
+    # only the literal strings, extra is not evaluated
+    assert releash.setup_py_requirements(filename) == ['a>=1.0', 'six']
+
+
+def test_setup_py_requirements_tuple(tmp_path):
+    filename = str(tmp_path / 'setup.py')
+    with open(filename, 'w') as f:
+        f.write("from setuptools import setup\nsetup(name='b', install_requires=('a',))\n")
+    assert releash.setup_py_requirements(filename) == ['a']
@@ -0,0 +1,137 @@
+import hashlib
+import os
+import re
+
+import pytest
+
+try:
+    from http.server import BaseHTTPRequestHandler
+except ImportError:  # py2
+    from BaseHTTPServer import BaseHTTPRequestHandler
+
+import releash
+
+
+def make_handler(content, failures=(), truncate_first=False):
+    """Handler serving content with Range support. failures are status codes to answer first,
+    with truncate_first the first response announces the whole content but stops halfway."""
+
+    class Handler(BaseHTTPRequestHandler):
+        requests = []
+        todo = list(failures)
+        truncate = [truncate_first]
+
+        def do_GET(self):
+            range_header = self.headers.get('Range')
+            self.requests.append(range_header)
+            if self.todo:
+                self.send_error(self.todo.pop(0))
+                return
+            offset = int(re.match(r'bytes=(\d+)-', range_header).group(1)) if range_header else 0
+            if offset > len(content):
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206 if offset else 200)
+            self.send_header('Content-Length', str(len(content) - offset))
+            self.end_headers()
+            if self.truncate[0]:
+                self.truncate[0] = False
+                self.wfile.write(content[offset:offset + len(content) // 2])
+                self.wfile.flush()
+                self.close_connection = True
+                return
+            self.wfile.write(content[offset:])
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Records the backoff delays, instead of sleeping"""
+    delays = []
+    monkeypatch.setattr(releash.time, 'sleep', delays.append)
+    return delays
+
+
+def test_download_is_cached(serve, tmp_path):
+    content = os.urandom(100000)
+    handler = make_handler(content)
+    url = serve(handler) + '/package-1.0.tar.gz'
+    downloader = releash.Downloader(str(tmp_path / 'downloads'))
+    filename = downloader.get(url)
+    with open(filename, 'rb') as f:
+        assert f.read() == content
+    assert os.path.basename(filename) == hashlib.sha256(content).hexdigest()
+    assert downloader.get(url) == filename
+    assert len(handler.requests) == 1
+
+
+def test_resume_with_range(serve, tmp_path, sleeps):
+    content = os.urandom(100000)
+    handler = make_handler(content, truncate_first=True)
+    url = serve(handler) + '/package-1.0.tar.gz'
+    filename = releash.Downloader(str(tmp_path / 'downloads')).get(url)
+    with open(filename, 'rb') as f:
+        assert f.read() == content
+    assert handler.requests == [None, 'bytes=%d-' % (len(content) // 2)]
+
+
+def test_backoff(serve, tmp_path, sleeps):
+    content = b'content'
+    handler = make_handler(content, failures=[503, 503, 500])
+    url = serve(handler) + '/package-1.0.tar.gz'
+    filename = releash.Downloader(str(tmp_path / 'downloads'), sleep=1, max_sleep=3).get(url)
+    with open(filename, 'rb') as f:
+        assert f.read() == content
+    assert len(handler.requests) == 4
+    # exponential, capped at max_sleep, with jitter between half and the full delay
+    for delay, maximum in zip(sleeps, [1, 2, 3]):
+        assert maximum / 2. <= delay <= maximum
+
+
+def test_client_error_is_not_retried(serve, tmp_path, sleeps):
+    handler = make_handler(b'', failures=[404])
+    url = serve(handler) + '/missing.tar.gz'
+    with pytest.raises(SystemExit):
+        releash.Downloader(str(tmp_path / 'downloads')).get(url)
+    assert len(handler.requests) == 1
+    assert sleeps == []
+
+
+def test_416_restarts_download(serve, tmp_path, sleeps):
+    content = os.urandom(1000)
+    handler = make_handler(content)
+    url = serve(handler) + '/package-1.0.tar.gz'
+    downloader = releash.Downloader(str(tmp_path / 'downloads'))
+    # a partial file that is not a prefix of the content on the server
+    partial = os.path.join(downloader.partial_path, hashlib.sha256(url.encode('utf8')).hexdigest())
+    with open(partial, 'wb') as f:
+        f.write(b'x' * 2000)
+    filename = downloader.get(url)
+    with open(filename, 'rb') as f:
+        assert f.read() == content
+    assert handler.requests == ['bytes=2000-', None]
+
+
+def test_eviction(serve, tmp_path):
+    first, second = os.urandom(100000), os.urandom(100000)
+    url = serve(make_handler(first)) + '/first.tar.gz'
+    path = str(tmp_path / 'downloads')
+    first_filename = releash.Downloader(path, max_bytes=150000).get(url)
+    releash._cache_in_use.clear()  # as if this is a new run
+    url = serve(make_handler(second)) + '/second.tar.gz'
+    second_filename = releash.Downloader(path, max_bytes=150000).get(url)
+    assert os.path.exists(second_filename)
+    assert not os.path.exists(first_filename)
+
+
+def test_no_eviction_of_a_download_larger_than_the_cache(serve, tmp_path):
+    content = os.urandom(300000)
+    url = serve(make_handler(content)) + '/large.tar.gz'
+    filename = releash.Downloader(str(tmp_path / 'downloads'), max_bytes=200000).get(url)
+    with open(filename, 'rb') as f:
+        assert f.read() == content
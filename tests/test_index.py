@@ -0,0 +1,114 @@
+import json
+import re
+
+import pytest
+
+try:
+    from http.server import BaseHTTPRequestHandler
+except ImportError:  # py2
+    from BaseHTTPServer import BaseHTTPRequestHandler
+
+import releash
+
+
+def make_json_api(published):
+    """Handler for a stand-in of the JSON API, published is {(name, version): [filenames]}"""
+
+    class Handler(BaseHTTPRequestHandler):
+        requests = []
+
+        def do_GET(self):
+            self.requests.append(self.path)
+            name, version = re.match(r'/pypi/([^/]+)/([^/]+)/json', self.path).groups()
+            if (name, version) not in published:
+                self.send_error(404)
+                return
+            etag = '"%d"' % len(published[name, version])
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            body = json.dumps(dict(urls=[dict(filename=k) for k in published[name, version]])).encode('utf-8')
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+
+def test_lookup_with_etag(serve, tmp_path):
+    handler = make_json_api({('pkg', '1.0'): ['pkg-1.0.tar.gz']})
+    index = releash.PackageIndex(serve(handler) + '/pypi', path=str(tmp_path))
+    assert index.files('pkg', '1.0') == {'pkg-1.0.tar.gz'}
+    assert index.files('pkg', '1.0') == {'pkg-1.0.tar.gz'}  # answered with 304 not modified
+    assert releash.PackageIndex(index.index_url, path=str(tmp_path), offline=True).files('pkg', '1.0') == \
+        {'pkg-1.0.tar.gz'}
+    assert len(handler.requests) == 2
+
+
+def test_missing_version_is_not_known_offline(serve, tmp_path):
+    published = {}
+    url = serve(make_json_api(published)) + '/pypi'
+    assert releash.PackageIndex(url, path=str(tmp_path)).files('pkg', '1.0') == set()
+    # it may have been uploaded since, so offline we do not know
+    assert releash.PackageIndex(url, path=str(tmp_path), offline=True).files('pkg', '1.0') is None
+    published['pkg', '1.0'] = ['pkg-1.0.tar.gz']
+    assert releash.PackageIndex(url, path=str(tmp_path)).files('pkg', '1.0') == {'pkg-1.0.tar.gz'}
+    assert releash.PackageIndex(url, path=str(tmp_path), offline=True).files('pkg', '1.0') == {'pkg-1.0.tar.gz'}
+
+
+@pytest.fixture
+def no_repository(monkeypatch, tmp_path):
+    monkeypatch.setenv('HOME', str(tmp_path))  # no ~/.pypirc
+    for name in ['TWINE_REPOSITORY_URL', 'RELEASH_INDEX_URL']:
+        monkeypatch.delenv(name, raising=False)
+
+
+def test_index_url_follows_the_upload_repository(no_repository, monkeypatch, tmp_path):
+    assert releash.index_url_for(releash.ReleaseTargetSourceDist(None)) == 'https://pypi.org/pypi'
+    assert releash.index_url_for(releash.ReleaseTargetUpload(None)) == 'https://pypi.org/pypi'
+    # we do not know the index of a private repository, unless told
+    private = 'https://private.example.com/legacy/'
+    assert releash.index_url_for(releash.ReleaseTargetUpload(None, private)) is None
+    assert releash.index_url_for(releash.ReleaseTargetUpload(None, private, 'https://private.example.com/json')) == \
+        'https://private.example.com/json'
+    monkeypatch.setenv('TWINE_REPOSITORY_URL', private)
+    assert releash.index_url_for(releash.ReleaseTargetSourceDist(None)) is None
+    monkeypatch.setenv('RELEASH_INDEX_URL', 'https://private.example.com/json')
+    assert releash.index_url_for(releash.ReleaseTargetSourceDist(None)) == 'https://private.example.com/json'
+    monkeypatch.delenv('TWINE_REPOSITORY_URL')
+    monkeypatch.delenv('RELEASH_INDEX_URL')
+    with open(str(tmp_path / '.pypirc'), 'w') as f:
+        f.write('[pypi]\nrepository = https://test.pypi.org/legacy/\n')
+    assert releash.index_url_for(releash.ReleaseTargetSourceDist(None)) == 'https://test.pypi.org/pypi'
+
+
+class Package(object):
+    def __init__(self, name, version, target):
+        self.name = self.distribution_name = name
+        self.version_source = version
+        self.target = target
+
+    def find_index_target(self):
+        return self.target
+
+
+def test_lookup_published_files(serve, no_repository, monkeypatch):
+    handler = make_json_api({('a', '1.0'): ['a-1.0.tar.gz'], ('b', '2.0'): ['b-2.0.tar.gz']})
+    url = serve(handler) + '/pypi'
+    monkeypatch.setattr(releash, '_published_files', {})
+    packages = [Package('a', '1.0', releash.ReleaseTargetUpload(None, index_url=url)),
+                Package('b', '2.0', releash.ReleaseTargetUpload(None, 'https://private.example.com/legacy/')),
+                Package('c', '3.0', releash.ReleaseTargetUpload(None, index_url=url))]
+    monkeypatch.setattr(releash, 'dry_run', True)  # only earlier answers, there are none
+    releash.lookup_published_files(packages)
+    assert handler.requests == []
+    assert [releash.published_files(k) for k in packages] == [set(), set(), set()]
+    monkeypatch.setattr(releash, 'dry_run', False)
+    releash.lookup_published_files(packages)
+    assert sorted(handler.requests) == ['/pypi/a/1.0/json', '/pypi/c/3.0/json']
+    assert [releash.published_files(k) for k in packages] == [{'a-1.0.tar.gz'}, set(), set()]
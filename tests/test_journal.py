@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+try:
+    import builtins
+except ImportError:  # py2
+    import __builtin__ as builtins
+
+import releash
+
+
+@pytest.fixture
+def plan(tmp_path, monkeypatch):
+    """A plan with a command and a function step, compiled outside of a git repo"""
+    monkeypatch.chdir(str(tmp_path))
+    done = []
+
+    def compile():
+        releash.execute('touch command-done')
+        releash.execute_function('upload something', lambda: done.append('upload'))
+    plan = releash.compile_plan(compile)
+    plan.done = done
+    return plan
+
+
+@pytest.fixture
+def answers(monkeypatch):
+    """Answers the interactive prompts with the given answers"""
+    todo = []
+    monkeypatch.setattr(releash, 'interactive', True)
+    monkeypatch.setattr(builtins, 'input', lambda prompt: todo.pop(0))
+    return todo
+
+
+def test_finished_steps_are_skipped_on_resume(plan, tmp_path):
+    journal = releash.Journal(str(tmp_path))
+    plan.run(journal=journal)
+    assert plan.done == ['upload']
+    assert os.path.exists('command-done')
+    os.remove('command-done')
+    plan.run(journal=releash.Journal(str(tmp_path)), resume=True)
+    assert plan.done == ['upload']
+    assert not os.path.exists('command-done')
+
+
+def test_declined_steps_are_not_recorded(plan, tmp_path, answers):
+    answers.extend(['n', 'n'])
+    plan.run(journal=releash.Journal(str(tmp_path)))
+    assert plan.done == []
+    assert not os.path.exists('command-done')
+    assert releash.Journal(str(tmp_path)).finished == set()
+    # so resuming does them
+    answers.extend(['y', 'y'])
+    plan.run(journal=releash.Journal(str(tmp_path)), resume=True)
+    assert plan.done == ['upload']
+    assert os.path.exists('command-done')
+    assert len(releash.Journal(str(tmp_path)).finished) == 2
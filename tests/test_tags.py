@@ -0,0 +1,66 @@
+import subprocess
+
+import pytest
+
+import releash
+
+
+def git(*args):
+    return subprocess.check_output(('git',) + args).decode('utf-8').strip()
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    monkeypatch.setattr(releash, '_last_commit', None)
+    monkeypatch.setattr(releash, '_tag_index', None)
+    git('init', '-q')
+    git('config', 'user.email', 'test@example.com')
+    git('config', 'user.name', 'test')
+    git('commit', '-q', '--allow-empty', '-m', 'initial')
+    return tmp_path
+
+
+def commit_file(name, msg):
+    with open(name, 'w') as f:
+        f.write(msg)
+    releash.git_commit(msg, [name])
+
+
+def test_tags_point_to_the_commit_before_them(repo):
+    initial = git('rev-parse', 'HEAD')
+    with releash.tag_batch() as batch:
+        batch.add('v0', None)
+        commit_file('a', 'a released')
+        batch.add('a-v1', 'a version 1')
+        commit_file('b', 'b released')
+        batch.add('b-v1', 'b version 1')
+    commits = git('rev-list', '--max-count=2', 'HEAD').split()
+    assert git('rev-parse', 'v0^{commit}') == initial
+    assert git('rev-parse', 'a-v1^{commit}') == commits[1]
+    assert git('rev-parse', 'b-v1^{commit}') == commits[0]
+    assert git('cat-file', '-t', 'a-v1') == 'tag'  # annotated
+    assert git('cat-file', '-t', 'v0') == 'commit'  # lightweight
+
+
+def test_tags_are_all_or_nothing(repo):
+    git('tag', 'b-v1')
+    batch = releash.TagBatch()
+    batch.add('a-v1', 'a version 1')
+    batch.add('b-v1', 'b version 1')
+    with pytest.raises(SystemExit):
+        batch.flush()
+    assert git('tag', '--list') == 'b-v1'
+
+
+def test_no_tag_when_the_commit_was_declined(repo, monkeypatch):
+    confirm = releash.confirm
+    monkeypatch.setattr(releash, 'confirm', lambda description, prompt='Run command':
+                        not description.startswith('git commit -m "b') and confirm(description, prompt))
+    with releash.tag_batch() as batch:
+        commit_file('a', 'a released')
+        batch.add('a-v1', 'a version 1')
+        commit_file('b', 'b released')
+        batch.add('b-v1', 'b version 1')
+    assert git('tag', '--list') == 'a-v1'
+    assert git('rev-parse', 'a-v1^{commit}') == git('rev-parse', 'HEAD')
@@ -0,0 +1,135 @@
+import base64
+import email.parser
+import hashlib
+import io
+import os
+import tarfile
+
+import pytest
+
+try:
+    from http.server import BaseHTTPRequestHandler
+except ImportError:  # py2
+    from BaseHTTPServer import BaseHTTPRequestHandler
+
+import releash
+
+
+def make_index(status=200):
+    """Handler for a stand-in of the legacy upload API, that records the uploads and connections"""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep alive
+        uploads = []
+        connections = set()
+
+        def do_POST(self):
+            self.connections.add(self.client_address)
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            message = email.parser.BytesParser().parsebytes(
+                b'Content-Type: ' + self.headers['Content-Type'].encode('ascii') + b'\r\n\r\n' + body)
+            fields = {}
+            for part in message.get_payload():
+                name = part.get_param('name', header='content-disposition')
+                fields.setdefault(name, []).append(part.get_payload(decode=True))
+            self.uploads.append((self.headers['Authorization'], fields))
+            reply = b'OK' if status == 200 else b'File already exists'
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(reply)))
+            self.end_headers()
+            self.wfile.write(reply)
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+
+def make_sdist(directory, name, version):
+    """Writes a minimal sdist with a PKG-INFO, and returns its filename"""
+    pkg_info = ('Metadata-Version: 2.1\nName: {name}\nVersion: {version}\nSummary: test package\n'
+                'Classifier: Programming Language :: Python\nClassifier: License :: OSI Approved\n'
+                'Requires-Dist: six\n\nThe description\n').format(name=name, version=version).encode('utf-8')
+    filename = os.path.join(directory, '{}-{}.tar.gz'.format(name, version))
+    with tarfile.open(filename, 'w:gz') as archive:
+        for path, data in [('PKG-INFO', pkg_info), ('setup.py', b'from setuptools import setup\n')]:
+            info = tarfile.TarInfo('{}-{}/{}'.format(name, version, path))
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return filename
+
+
+@pytest.fixture
+def credentials(monkeypatch, tmp_path):
+    monkeypatch.setenv('HOME', str(tmp_path))  # no ~/.pypirc
+    monkeypatch.setenv('TWINE_USERNAME', 'user')
+    monkeypatch.setenv('TWINE_PASSWORD', 'secret')
+    monkeypatch.delenv('TWINE_REPOSITORY_URL', raising=False)
+
+
+def test_upload_over_one_connection(serve, tmp_path, credentials):
+    handler = make_index()
+    uploader = releash.Uploader(serve(handler) + '/legacy/')
+    filenames = [make_sdist(str(tmp_path), 'pkg%d' % i, '1.0.%d' % i) for i in range(3)]
+    for filename in filenames:
+        uploader.upload(filename)
+    assert len(handler.connections) == 1
+    assert len(handler.uploads) == 3
+    for filename, (authorization, fields) in zip(filenames, handler.uploads):
+        with open(filename, 'rb') as f:
+            content = f.read()
+        assert authorization == 'Basic ' + base64.b64encode(b'user:secret').decode('ascii')
+        assert fields[':action'] == [b'file_upload']
+        assert fields['filetype'] == [b'sdist']
+        assert fields['content'] == [content]
+        assert fields['sha256_digest'] == [hashlib.sha256(content).hexdigest().encode('ascii')]
+        assert fields['md5_digest'] == [hashlib.md5(content).hexdigest().encode('ascii')]
+        assert fields['classifiers'] == [b'Programming Language :: Python', b'License :: OSI Approved']
+        assert fields['requires_dist'] == [b'six']
+        assert fields['description'] == [b'The description\n']
+    assert [fields['name'] for authorization, fields in handler.uploads] == [[b'pkg0'], [b'pkg1'], [b'pkg2']]
+    assert [fields['version'] for authorization, fields in handler.uploads] == [[b'1.0.0'], [b'1.0.1'], [b'1.0.2']]
+
+
+def test_upload_failure(serve, tmp_path, credentials):
+    uploader = releash.Uploader(serve(make_index(status=400)) + '/legacy/')
+    with pytest.raises(SystemExit):
+        uploader.upload(make_sdist(str(tmp_path), 'pkg', '1.0'))
+
+
+def test_credentials_from_pypirc(monkeypatch, tmp_path):
+    for name in ['TWINE_USERNAME', 'TWINE_PASSWORD', 'TWINE_REPOSITORY_URL']:
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv('HOME', str(tmp_path))
+    with open(str(tmp_path / '.pypirc'), 'w') as f:
+        f.write('[pypi]\nrepository = https://index.example.com/legacy/\nusername = alice\npassword = pw\n')
+    uploader = releash.Uploader()
+    assert uploader.repository_url == 'https://index.example.com/legacy/'
+    assert uploader.authorization == 'Basic ' + base64.b64encode(b'alice:pw').decode('ascii')
+    # the environment takes precedence
+    monkeypatch.setenv('TWINE_USERNAME', 'bob')
+    monkeypatch.setenv('TWINE_REPOSITORY_URL', 'https://other.example.com/legacy/')
+    uploader = releash.Uploader()
+    assert uploader.repository_url == 'https://other.example.com/legacy/'
+    assert uploader.authorization == 'Basic ' + base64.b64encode(b'bob:pw').decode('ascii')
+
+
+def test_missing_credentials(monkeypatch, tmp_path):
+    for name in ['TWINE_USERNAME', 'TWINE_PASSWORD', 'TWINE_REPOSITORY_URL']:
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv('HOME', str(tmp_path))
+    with pytest.raises(SystemExit):
+        releash.Uploader()
+
+
+def test_parallel_uploads_share_connections(serve, tmp_path, credentials):
+    from multiprocessing.pool import ThreadPool
+    handler = make_index()
+    uploader = releash.Uploader(serve(handler) + '/legacy/', max_connections=2)
+    filenames = [make_sdist(str(tmp_path), 'pkg%d' % i, '1.0') for i in range(8)]
+    pool = ThreadPool(4)
+    try:
+        pool.map(uploader.upload, filenames)
+    finally:
+        pool.close()
+    assert len(handler.uploads) == 8
+    assert len(handler.connections) <= 2
@@ -0,0 +1,87 @@
+import os
+
+import pytest
+
+import releash
+
+
+@pytest.fixture
+def files(tmp_path):
+    filenames = []
+    for name in ['a.py', 'b.py']:
+        filename = str(tmp_path / name)
+        with open(filename, 'w') as f:
+            f.write("version = '1.0'\n")
+        filenames.append(filename)
+    return filenames
+
+
+def read(filename):
+    with open(filename) as f:
+        return f.read()
+
+
+def bump(content):
+    return content.replace('1.0', '1.1')
+
+
+def test_edits_are_written_at_the_end(files):
+    with releash.write_session():
+        for filename in files:
+            releash.edit_file(filename, bump)
+            assert read(filename) == "version = '1.0'\n"
+    assert [read(k) for k in files] == ["version = '1.1'\n"] * 2
+
+
+def test_edits_of_a_file_are_combined(files):
+    with releash.write_session() as session:
+        releash.edit_file(files[0], bump)
+        releash.edit_file(files[0], lambda content: content + 'extra = 1\n')
+        assert list(session.edits) == [files[0]]
+    assert read(files[0]) == "version = '1.1'\nextra = 1\n"
+
+
+def test_nothing_is_written_on_an_error(files):
+    with pytest.raises(RuntimeError):
+        with releash.write_session():
+            releash.edit_file(files[0], bump)
+            raise RuntimeError('failure in a later target')
+    assert read(files[0]) == "version = '1.0'\n"
+
+
+def test_dry_run(files, monkeypatch):
+    monkeypatch.setattr(releash, 'dry_run', True)
+    with releash.write_session():
+        releash.edit_file(files[0], bump)
+    assert read(files[0]) == "version = '1.0'\n"
+
+
+def test_rollback_when_replacing_fails(files, monkeypatch):
+    replace = os.replace
+
+    def failing_replace(source, target):
+        if target == files[1] and source.endswith('.releash-tmp') and not failing_replace.failed:
+            failing_replace.failed = True
+            raise OSError('disk full')
+        replace(source, target)
+    failing_replace.failed = False
+    monkeypatch.setattr(releash.os, 'replace', failing_replace)
+    with pytest.raises(OSError):
+        with releash.write_session():
+            for filename in files:
+                releash.edit_file(filename, bump)
+    # the first file was already replaced, and is restored
+    assert [read(k) for k in files] == ["version = '1.0'\n"] * 2
+    assert sorted(os.listdir(os.path.dirname(files[0]))) == ['a.py', 'b.py']
+
+
+def test_edits_of_different_spellings_of_a_file_are_combined(files, monkeypatch):
+    directory, name = os.path.split(files[0])
+    monkeypatch.chdir(directory)
+    with releash.write_session() as session:
+        releash.edit_file(name, bump)
+        releash.edit_file(os.path.join('.', name), lambda content: content + 'extra = 1\n')
+        releash.edit_file(os.path.join('..', os.path.basename(directory), name), lambda content: content + '# end\n')
+        assert list(session.edits) == [files[0]]
+    assert read(files[0]) == "version = '1.1'\nextra = 1\n# end\n"
+    assert sorted(os.listdir(directory)) == ['a.py', 'b.py']